@@ -4,7 +4,11 @@ import os
 import sys
 import numpy as np
 import pandas as pd
-import netCDF4 as nc
+import Profiler
+import Flags
+import CostCube
+import KppExtract
+import KppSeries
 
 # Input argument enumeration
 class InputArg:
@@ -20,58 +24,35 @@ class ErrorCode:
     KEY_NOT_FOUND = 3
     ASSERTION_FAILED = -1
 
-# Check if a file is a KPP diagnostics file
-def isKppDiagsFile(file: str) -> bool:
-    return file.startswith('GEOSChem.KppDiags.') and file.endswith('.nc4')
-
-# Convert the directory named 'GEOSChem.KppDiags.*.nc4' to the timestamp
-# @note: assumes that the file name is in the format 'GEOSChem.KppDiags.*.nc4'
-def convertKppDiagsFileToTimestamp(file: str) -> str:
-    # split the file name into parts
-    parts = os.path.basename(file).split('.')
-    # extract the timestamp from the parts
-    timestamp = parts[2]
-    return timestamp
-
-# Find all files in directory named 'GEOSChem.KppDiags.*.nc4'
-def findKppDiagsFiles(directory) -> dict[str, str]:
-    # dictionary to store the files by timestamp
-    files = {}
-    for filename in os.listdir(directory):
-        if isKppDiagsFile(filename):
-            files[convertKppDiagsFileToTimestamp(filename)] = os.path.join(directory, filename)
-    # sort files by timestamp
-    files = dict(sorted(files.items()))
-    return files
-
-# Read keys from the netCDF4 file
-def readKeys(file: str) -> list[str]:
-    with nc.Dataset(file, 'r') as f:
-        # keys of the variables to be read
-        keys = f.variables.keys()
-    return keys
-
-# Read variables from the netCDF4 file by key
-def readVariables(file: str, keys: list[str], roundup: bool = False) -> dict[str, np.ndarray]:
-    variables = {} 
-    with nc.Dataset(file, 'r') as f:
-        # read each variable
-        for key in keys:
-            # read the variable
-            var = f.variables[key][:]
-            # check if the variable is a masked array
-            if hasattr(var, 'mask'):
-                # convert the masked array to a ndarray
-                var = var.filled()
-            # round up the variable if needed
-            if roundup:
-                var = np.ceil(var)
-            # store the variable in the dictionary
-            variables[key] = var
-    return variables
+# Number of layers with KPP steps in the data array
+LAYERS = 59
+
+# Read the column total steps and any extra keys of each file in a single open through one KppDiagsSeries,
+# yielding the timestamp, file, costs per cell and the (layers, cells) variables
+# @note: only KppTotSteps is rounded up, and the optional keys, like the static KppRank, are read from the first
+#        file only and skipped if missing
+def readColumnCosts(files: dict[str, str], layers: int, keys: list[str] = [], optional: list[str] = []):
+    series = KppSeries.KppDiagsSeries(files, 'KppTotSteps')
+    for interval, timestamp in enumerate(series.timestamps):
+        file = series.files[timestamp]
+        # read only the layers needed of every variable in one open
+        try:
+            variables = series.readVariables(timestamp, keys, (slice(0, layers),), optional if interval == 0 else [])
+        except KeyError as e:
+            print('Error: {}'.format(e.args[0]))
+            sys.exit(ErrorCode.KEY_NOT_FOUND)
+        variables = {key: var.reshape(var.shape[0], -1) for key, var in variables.items()}
+
+        # sum the total steps for each column per cell in each layer
+        with Profiler.stage('sum', file):
+            costs = variables['KppTotSteps'].sum(axis=0, dtype=np.float64)
+        yield timestamp, file, costs, variables
 
 # Main function
 def main():
+    # enable profiling if requested
+    sys.argv = Profiler.parseFlag(sys.argv)
+
     # check if the user provided a directory
     if len(sys.argv) < InputArg.LENGTH:
         print('Usage: {} <directory>'.format(sys.argv[InputArg.PROGRAM_NAME]))
@@ -91,6 +72,24 @@ def main():
     debug = '-D' in flags or '--debug' in flags
     if debug:
         print('Debug: enabled.')
+    # memory map flag: '-M', '--mmap' or '--mmap=<directory>', publish the cost cube
+    mmap = '-M' in flags or '--mmap' in flags or Flags.getFlagValue(flags, None, '--mmap', separate=False) is not None
+    if mmap:
+        print('Memory map: enabled.')
+    # levels flag: '-L' or '--levels', also publish the per level cost cube
+    levels = '-L' in flags or '--levels' in flags
+    if levels:
+        print('Levels: enabled.')
+    # extract flag: '--extract=<spec>', extract more variables and reductions in the same pass
+    # spec is 'variable:reduction,...' or a JSON file, with reductions column, level, max and hist
+    extract = Flags.getFlagValue(flags, None, '--extract')
+    if extract is not None:
+        try:
+            spec = KppExtract.parseSpec(extract)
+        except (OSError, ValueError) as e:
+            print('Error: Invalid extraction spec \'{}\': {}'.format(extract, e))
+            sys.exit(ErrorCode.INVALID_ARGUMENTS)
+        print('Extract: {}.'.format(', '.join(reduction.key for reduction in spec)))
 
     # get the path from the command line
     path = sys.argv[InputArg.PATH]
@@ -101,7 +100,8 @@ def main():
         directory = path
 
         # find all KPP diagnostics files in the directory
-        files = findKppDiagsFiles(directory)
+        with Profiler.stage('find'):
+            files = KppSeries.findKppDiagsFiles(directory)
 
         # check if any files were found
         if len(files) == 0:
@@ -112,11 +112,11 @@ def main():
         directory = os.path.dirname(path)
         
         # check if the file is a KPP diagnostics file
-        if not isKppDiagsFile(path):
+        if not KppSeries.isKppDiagsFile(path):
             print('Error: \'{}\' is not a KPP diagnostics file.'.format(path))
             sys.exit(ErrorCode.FILE_NOT_FOUND)
         # set the file to be the only file
-        files = {convertKppDiagsFileToTimestamp(path): path}
+        files = {KppSeries.convertKppDiagsFileToTimestamp(path): path}
     else:
         print('Error: Invalid path \'{}\'.'.format(path))
         sys.exit(ErrorCode.FILE_NOT_FOUND)
@@ -125,89 +125,92 @@ def main():
     if not force:
         pass
     
-    # read the keys from the first file
-    file = next(iter(files.values()))
-    keys = readKeys(file)
-
-    # verify that we have the keys needed
-    requiredKey = 'KppTotSteps'
-    keysToRead = [requiredKey]
-
-    optionalKeys = ['KppRank']
-    if requiredKey not in keys:
-        print('Error: Missing keys {}'.format(requiredKey))
-        sys.exit(ErrorCode.KEY_NOT_FOUND)
-    haveOptionalKeys = all(key in keys for key in optionalKeys)
-
-    if haveOptionalKeys:
-        keysToRead += optionalKeys
-
-    # read the variables from the first file
-    variables = readVariables(file, keysToRead, roundup=True)
     # resolution of the data array
     resolution = 24
     # number of layers in the data array
-    layers = 59
+    layers = LAYERS
     # size of the data array
     size = 6 * resolution * resolution
 
-    # debug: verify the variables
-    if debug:
-        for key in requiredKeys:
-            # verify the shape is (1, 72, 6, resolution, resolution)
-            if variables[key].shape != (1, 72, 6, resolution, resolution):  
-                print('Error: {} shape is not (1, 72, 6, {}, {}).'.format(key, resolution, resolution))
-                exit(ErrorCode.ASSERTION_FAILED)
-            # verify that layers to 72 are all zeros
-            if variables[key][0][layers:72].any():
-                print(f'Error: {key} layers {layers} to 72 are not all zeros.')
-                exit(ErrorCode.ASSERTION_FAILED)
-
-    if haveOptionalKeys:
-        # create a DataFrame of size to store the rank and index on rank
-        rankDf = pd.DataFrame(index=range(size))
-        # flatten and store the ranks and indices on ranks for the first layer
-        rankDf['KppRank'] = variables['KppRank'][0][0].flatten().astype(int)
-        rankDf.to_csv('{}/RankIndex.csv'.format(directory), index=True)
-
-        # @maybe: update our simulation model so that it can read the assignment as a 1d array or 4d array (59, 6, resolution, resolution)
-        # write the DataFrame to a CSV file
-        # reshape the rank to a 6 * layers * resolution by resolution array
-        assignment = rankDf['KppRank'].values.reshape(6*resolution, resolution)
-        # write the reshaped assignment to an assignment file for our simulation model, separated by commas
-        np.savetxt('{}/original.assignment'.format(directory), assignment, fmt='%d', delimiter=',')
+    # the rank is read along with the total steps of the first file if it is available
+    optionalKeys = ['KppRank']
+
+    # create a store for the extracted variables
+    extraKeys = []
+    if extract is not None:
+        store = KppExtract.ExtractStore(spec, list(files.keys()))
+        extraKeys = KppExtract.specVariables(spec)
 
     # create a DataFrame of size to store the total steps
     costDf = pd.DataFrame(index=range(size))
     # read the variables from all the files
-    for timestamp, file in files.items():
-        # read the keys from the file
-        keys = readKeys(file)
-        # verify that we have the keys needed
-        requiredKeys = ['KppTotSteps']
-        missingKeys = [key for key in requiredKeys if key not in keys]
-        if len(missingKeys) > 0:
-            print('Missing keys: {}'.format(missingKeys))
-            sys.exit(ErrorCode.KEY_NOT_FOUND)
-
-        # read the variables from the file
-        variables = readVariables(file, requiredKeys, roundup=True)
-        
-        # sum the total steps for each column per cell in each layer
-        costs = np.zeros(size)
-        for layer in range(layers):
-            costs += variables['KppTotSteps'][0][layer].flatten()
+    for interval, (timestamp, file, costs, layerVariables) in enumerate(readColumnCosts(files, layers, extraKeys, optionalKeys)):
+        if interval == 0:
+            haveOptionalKeys = all(key in layerVariables for key in optionalKeys)
+
+            # debug: verify the total steps of the first file
+            if debug:
+                step = KppSeries.KppDiagsSeries({timestamp: file}).readStep(timestamp)
+                # verify the shape is (72, 6, resolution, resolution)
+                if step.shape != (72, 6, resolution, resolution):
+                    print('Error: KppTotSteps shape is not (72, 6, {}, {}).'.format(resolution, resolution))
+                    exit(ErrorCode.ASSERTION_FAILED)
+                # verify that layers to 72 are all zeros
+                if step[layers:72].any():
+                    print(f'Error: KppTotSteps layers {layers} to 72 are not all zeros.')
+                    exit(ErrorCode.ASSERTION_FAILED)
+
+            if haveOptionalKeys:
+                # create a DataFrame of size to store the rank and index on rank
+                rankDf = pd.DataFrame(index=range(size))
+                # flatten and store the ranks and indices on ranks for the first layer
+                rankDf['KppRank'] = layerVariables['KppRank'][0].astype(int)
+                rankDf.to_csv('{}/RankIndex.csv'.format(directory), index=True)
+
+                # @maybe: update our simulation model so that it can read the assignment as a 1d array or 4d array (59, 6, resolution, resolution)
+                # write the DataFrame to a CSV file
+                # reshape the rank to a 6 * layers * resolution by resolution array
+                assignment = rankDf['KppRank'].values.reshape(6*resolution, resolution)
+                # write the reshaped assignment to an assignment file for our simulation model, separated by commas
+                np.savetxt('{}/original.assignment'.format(directory), assignment, fmt='%d', delimiter=',')
+
+            # create a memory-mapped cost cube to publish the total steps
+            if mmap:
+                cubeDirectory = Flags.getFlagValue(flags, None, '--mmap', directory, separate=False)
+                num_ranks = int(layerVariables['KppRank'].max()) + 1 if haveOptionalKeys else None
+                cube = CostCube.CostCubeWriter(cubeDirectory, list(files.keys()), size, resolution, num_ranks, layers if levels else None)
+
+        if mmap:
+            cube.write(interval, costs, layerVariables['KppTotSteps'])
+        if extract is not None:
+            store.add(interval, layerVariables)
         if debug:
             print('Total steps for {}: {}'.format(timestamp, costs))
         intervalDf = pd.DataFrame(costs, columns=[timestamp])
         if separation:
             # write the DataFrame to a CSV file
-            costDf.to_csv('{}/{}.csv'.format(directory, timestamp), index=True)
+            intervalFile = '{}/{}.csv'.format(directory, timestamp)
+            with Profiler.stage('write', intervalFile):
+                costDf.to_csv(intervalFile, index=True)
         else:
             # concatenate the interval DataFrame to the cost DataFrame
-            costDf = pd.concat([costDf, intervalDf], axis=1)
+            with Profiler.stage('concat', file):
+                costDf = pd.concat([costDf, intervalDf], axis=1)
     # write the DataFrame to a CSV file
-    costDf.to_csv('{}/TotalSteps.csv'.format(directory), index=True)
+    totalFile = '{}/TotalSteps.csv'.format(directory)
+    with Profiler.stage('write', totalFile):
+        costDf.to_csv(totalFile, index=True)
+
+    # publish the memory-mapped cost cube
+    if mmap:
+        cube.close()
+
+    # write the extracted variables to a single store
+    if extract is not None:
+        store.save(os.path.join(directory, KppExtract.EXTRACT_FILE))
+
+    # report the profile if enabled
+    Profiler.report('{}/AggKppSteps.profile.json'.format(directory))
 
 # Run the main function
 if __name__ == '__main__':
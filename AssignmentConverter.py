@@ -5,6 +5,7 @@ import sys
 import re
 import numpy as np
 import pandas as pd
+import Profiler
 
 # Input argument enumeration
 class InputArg:
@@ -23,22 +24,188 @@ class ErrorCode:
 
 # Read in the assignment file and the rank index csv file, convert the assignment to a mapping to target rank for balancing for each rank.
 
+# Pattern of the interval number in the assignment file names
+INTERVAL_PATTERN = re.compile(r'interval_(\d+)\.assignment')
+
+# File names of the delta-encoded mappings and the migration statistics
+DELTA_MAPPINGS_FILE = 'mappings.npz'
+MIGRATION_STATS_FILE = 'MigrationStats.csv'
+
+# Compute the 1-based index of each cell on its rank, in cell order
+# @note: used when the rank index does not provide KppIndexOnRank
+def computeIndexOnRank(ranks: np.ndarray) -> np.ndarray:
+    counts = np.bincount(ranks)
+    starts = np.cumsum(counts) - counts
+    order = np.argsort(ranks, kind='stable')
+    indices = np.empty_like(ranks)
+    indices[order] = np.arange(len(ranks)) - np.repeat(starts, counts) + 1
+    return indices
+
+# Find the assignment files in a file or directory, keyed and sorted by interval number
+def findAssignmentFiles(path: str) -> dict[int, str]:
+    # If the path is a directory, consider all the files in the directory
+    if os.path.isdir(path):
+        candidates = [os.path.join(path, filename) for filename in os.listdir(path)]
+    else:
+        candidates = [path]
+
+    files = {}
+    for file in candidates:
+        # Extract interval number using the compiled regex
+        match = INTERVAL_PATTERN.search(file)
+        if match:
+            files[int(match.group(1))] = file
+        else:
+            # Skip the file if the interval number is not found
+            print('Error: Interval number not found in assignment file name \'{}\'.'.format(file))
+    return dict(sorted(files.items()))
+
+# Read an assignment file as a flat array of target ranks per cell
+def readAssignment(file: str) -> np.ndarray:
+    with Profiler.stage('read', file):
+        assignment = pd.read_csv(file, header=None)
+    return assignment.values.flatten().astype(int)
+
+# Check that every target rank of an assignment is a valid rank, exiting otherwise
+def validateAssignment(file: str, assignment: np.ndarray, num_ranks: int):
+    invalid = (assignment < 0) | (assignment >= num_ranks)
+    if invalid.any():
+        print('Error: Assignment file \'{}\' has {} target ranks outside of 0 to {}, e.g. {}.'.format(
+            file, invalid.sum(), num_ranks - 1, assignment[invalid][0]))
+        sys.exit(ErrorCode.ASSERTION_FAILED)
+
+# Convert an assignment to a (ranks, indices) mapping to target rank, -1 where a rank has no cell at the index
+def convertAssignment(ranks: np.ndarray, indices: np.ndarray, assignment: np.ndarray, num_ranks: int, num_indices: int) -> np.ndarray:
+    mapping = np.full((num_ranks, num_indices), -1, dtype=int)
+    mapping[ranks, indices - 1] = assignment
+    return mapping
+
+# Write the mapping of each rank over all intervals to a csv file per rank
+# @note: mappings is an (intervals, ranks, indices) array, unused indices are written as empty fields
+def writeRankMappings(mapping_dir: str, mappings: np.ndarray):
+    # Create a Mappings directory if it does not exist
+    if not os.path.exists(mapping_dir):
+        os.makedirs(mapping_dir)
+
+    for rank in range(mappings.shape[1]):
+        # Create a dataframe to store the mapping for the rank
+        rank_mapping = mappings[:, rank, :]
+        rank_mapping = pd.DataFrame(rank_mapping, dtype='Int64').mask(rank_mapping < 0)
+        # Write the rank mapping to a csv file
+        rank_file = os.path.join(mapping_dir, 'rank_{}.csv'.format(rank))
+        with Profiler.stage('write', rank_file):
+            rank_mapping.to_csv(rank_file, header=False, index=False)
+
+# Delta-encode the (intervals, ranks, indices) mappings as the first mapping plus the changed slots of each later interval
+# @note: slots are flattened as rank * num_indices + index, the changes of interval i are indices[offsets[i]:offsets[i + 1]]
+def encodeDeltaMappings(mappings: np.ndarray) -> dict[str, np.ndarray]:
+    flat = mappings.reshape(mappings.shape[0], -1)
+    changed = np.zeros_like(flat, dtype=bool)
+    changed[1:] = flat[1:] != flat[:-1]
+    intervals, slots = np.nonzero(changed)
+    offsets = np.zeros(mappings.shape[0] + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(intervals, minlength=mappings.shape[0]))
+    return {
+        'base': mappings[0],
+        'offsets': offsets,
+        'indices': slots.astype(np.int64),
+        'targets': flat[intervals, slots],
+    }
+
+# Write the delta-encoded mappings with the interval numbers they belong to
+def writeDeltaMappings(file: str, mappings: np.ndarray, interval_numbers: list[int]):
+    with Profiler.stage('write', file):
+        np.savez_compressed(file, intervals=np.array(interval_numbers), **encodeDeltaMappings(mappings))
+
+# Read delta-encoded mappings into memory
+def readDeltaMappings(file: str) -> dict[str, np.ndarray]:
+    with Profiler.stage('read', file), np.load(file) as delta:
+        return {key: delta[key] for key in delta.files}
+
+# Reconstruct the (ranks, indices) mapping of an interval, by position in the delta-encoded mappings
+def reconstructMapping(delta: dict[str, np.ndarray], interval: int) -> np.ndarray:
+    mapping = delta['base'].copy()
+    flat = mapping.reshape(-1)
+    # the changes are in interval order, so applying them in order leaves the latest target in each slot
+    end = delta['offsets'][interval + 1]
+    flat[delta['indices'][:end]] = delta['targets'][:end]
+    return mapping
+
+# Compute per rank per interval migration statistics of the (intervals, ranks, indices) mappings
+# Cells: cells on the rank, Migrated: cells sent to another rank, FanOut: distinct other ranks sent to,
+# Changed: cells whose target differs from the previous interval
+def migrationStatistics(mappings: np.ndarray, interval_numbers: list[int]) -> pd.DataFrame:
+    num_intervals, num_ranks, num_indices = mappings.shape
+    own = np.arange(num_ranks).reshape(1, -1, 1)
+    valid = mappings >= 0
+    migrated = valid & (mappings != own)
+
+    # count the distinct (interval, rank, target) triples of the migrated cells
+    # @note: targets are packed with a base covering every target, even ones beyond the ranks of the rank index
+    base = max(num_ranks, int(mappings.max()) + 1)
+    interval, rank, _ = np.nonzero(migrated)
+    pairs = np.unique((interval * num_ranks + rank).astype(np.int64) * base + mappings[migrated])
+    fanout = np.bincount(pairs // base, minlength=num_intervals * num_ranks).reshape(num_intervals, num_ranks)
+
+    changed = np.zeros((num_intervals, num_ranks), dtype=int)
+    changed[1:] = (mappings[1:] != mappings[:-1]).sum(axis=2)
+
+    return pd.DataFrame({
+        'Interval': np.repeat(interval_numbers, num_ranks),
+        'Rank': np.tile(np.arange(num_ranks), num_intervals),
+        'Cells': valid.sum(axis=2).flatten(),
+        'Migrated': migrated.sum(axis=2).flatten(),
+        'FanOut': fanout.flatten(),
+        'Changed': changed.flatten(),
+    })
+
+# Write the migration statistics and print a summary
+def writeMigrationStatistics(file: str, stats: pd.DataFrame):
+    with Profiler.stage('write', file):
+        stats.to_csv(file, index=False)
+    print('Total migrated cells: {}'.format(stats['Migrated'].sum()))
+    print('Maximum fan-out: {}'.format(stats['FanOut'].max()))
+    print('Mean fan-out: {:.2f}'.format(stats['FanOut'].mean()))
+    print('Total changed cells between intervals: {}'.format(stats['Changed'].sum()))
+
 def main():
+    # Enable profiling if requested
+    sys.argv = Profiler.parseFlag(sys.argv)
+
     # Validate the input arguments
     if len(sys.argv) < InputArg.LENGTH:
-        print('Usage: {} <rank_index_file> <assignment_file/directory>'.format(sys.argv[InputArg.PROGRAM_NAME]))
+        print('Usage: {} <rank_index_file> <assignment_file/directory> [-d] [-s]'.format(sys.argv[InputArg.PROGRAM_NAME]))
         sys.exit(ErrorCode.INVALID_ARGUMENTS)
 
+    # Optionally check for flags
+    flags = sys.argv[InputArg.LENGTH:]
+    # Delta flag: '-d' or '--delta', write delta-encoded mappings instead of a csv file per rank
+    delta = '-d' in flags or '--delta' in flags
+    if delta:
+        print('Delta: enabled.')
+    # Statistics flag: '-s' or '--stats', write the migration statistics
+    stats = '-s' in flags or '--stats' in flags
+    if stats:
+        print('Statistics: enabled.')
+
     # Read in the rank index file
     rank_index_file = sys.argv[InputArg.RANK_INDEX_FILE]
     if not os.path.exists(rank_index_file):
         print('Error: Rank index file \'{}\' not found.'.format(rank_index_file))
         sys.exit(ErrorCode.FILE_NOT_FOUND)
-    rank_index = pd.read_csv(rank_index_file)
+    with Profiler.stage('read', rank_index_file):
+        rank_index = pd.read_csv(rank_index_file)
+    ranks = rank_index['KppRank'].values
+    # The rank index written by AggKppSteps only has KppRank, derive the indices on rank from the cell order
+    if 'KppIndexOnRank' in rank_index:
+        indices = rank_index['KppIndexOnRank'].values
+    else:
+        print('Warning: KppIndexOnRank not found in rank index file, deriving it from the cell order.')
+        indices = computeIndexOnRank(ranks)
 
     # Retrieve number of ranks and indices on rank
-    num_ranks = max(rank_index['KppRank']) + 1
-    num_indices = max(rank_index['KppIndexOnRank'])
+    num_ranks = max(ranks) + 1
+    num_indices = max(indices)
     num_cells = len(rank_index)
 
     print('Number of ranks: {}'.format(num_ranks))
@@ -50,81 +217,50 @@ def main():
     if not os.path.exists(assignment_file):
         print('Error: Assignment file/directory \'{}\' not found.'.format(assignment_file))
         sys.exit(ErrorCode.FILE_NOT_FOUND)
-    # If the assignment file is a directory, read in all the files in the directory
-    files = []
-    if os.path.isdir(assignment_file):
-        for filename in os.listdir(assignment_file):
-            files.append(os.path.join(assignment_file, filename))
-    else:
-        files.append(assignment_file)
+    files = findAssignmentFiles(assignment_file)
+    if len(files) == 0:
+        print('Error: No interval_N.assignment files found in \'{}\'.'.format(assignment_file))
+        sys.exit(ErrorCode.FILE_NOT_FOUND)
 
     # Retrieve number of intervals
     num_intervals = len(files)
     print('Number of intervals: {}'.format(num_intervals))
     
-    # Create an dictionary of interval number to mapping
-    mappings = {}
-    # Compile the regex pattern
-    interval_pattern = re.compile(r'interval_(\d+)\.assignment')
+    # Array of the mapping of each interval, in interval order
+    mappings = np.empty((num_intervals, num_ranks, num_indices), dtype=int)
 
-    for file in files:
+    for interval, (interval_number, file) in enumerate(files.items()):
         print('Reading assignment file: {}'.format(file))
-        # Extract interval number using the compiled regex
-        match = interval_pattern.search(file)
-        if match:
-            # Extract the interval number
-            interval_number = int(match.group(1))
-            print('Processing interval: {}'.format(interval_number))
-        else:
-            # Skip the file if the interval number is not found
-            print('Error: Interval number not found in assignment file name.')
-            continue
-        assignment = pd.read_csv(file, header=None)
-        # Flatten the assignment dataframe
-        assignment = assignment.values.flatten()
+        print('Processing interval: {}'.format(interval_number))
+        assignment = readAssignment(file)
         # Check if the number of cells in the assignment file matches the number of cells in the rank index file
         if len(assignment) != num_cells:
             print('Error: Number of cells in assignment file does not match number of cells in rank index file.')
             sys.exit(ErrorCode.ASSERTION_FAILED)
+        validateAssignment(file, assignment, num_ranks)
 
-        # Create a panda dataframe to store the mapping of assignment to target rank
-        mapping = pd.DataFrame(index=range(num_ranks), columns=range(num_indices))
-
-        # Set of reassigned ranks for each rank
-        sets = [set() for _ in range(num_ranks)]
-
-        # Iterate through the assignment file and populate the mapping
-        for i in range(num_cells):
-            rank = rank_index['KppRank'][i]
-            index = rank_index['KppIndexOnRank'][i] - 1
-            target_rank = assignment[i].astype(int)
-            mapping.at[rank, index] = target_rank
-            sets[rank].add(target_rank)
+        with Profiler.stage('convert', file):
+            mappings[interval] = convertAssignment(ranks, indices, assignment, num_ranks, num_indices)
 
-        # Append the mapping to the mappings dictionary
-        mappings[interval_number] = mapping
-
-        # # Print the number of unique target ranks for each rank
-        # for i in range(num_ranks):
-        #     print('Rank {}: {}'.format(i, len(sets[i])))
-
-    # Create a Mappings directory if it does not exist
+    # Write the mappings to the Mappings directory
     mapping_dir = assignment_file.replace('Assignments', 'Mappings')
-    if not os.path.exists(mapping_dir):
-        os.makedirs(mapping_dir)
+    if delta:
+        os.makedirs(mapping_dir, exist_ok=True)
+        writeDeltaMappings(os.path.join(mapping_dir, DELTA_MAPPINGS_FILE), mappings, list(files.keys()))
+    else:
+        writeRankMappings(mapping_dir, mappings)
 
-    # Convert the mappings dictionary to a dataframe per rank
-    for rank in range(num_ranks):
-        # Create a dataframe to store the mapping for the rank
-        rank_mapping = pd.DataFrame(index=range(num_intervals), columns=range(num_indices))
-        for interval in range(num_intervals):
-            rank_mapping.at[interval, :] = mappings[interval].loc[rank, :]
-        # Write the rank mapping to a csv file
-        rank_mapping.to_csv(os.path.join(mapping_dir, 'rank_{}.csv'.format(rank)), header=False, index=False)
+    # Write the migration statistics
+    if stats:
+        os.makedirs(mapping_dir, exist_ok=True)
+        writeMigrationStatistics(os.path.join(mapping_dir, MIGRATION_STATS_FILE), migrationStatistics(mappings, list(files.keys())))
 
     # Make a Mappings directory if it does not exist
     if not os.path.exists('Mappings'):
         os.makedirs('Mappings')
 
+    # Report the profile if enabled
+    Profiler.report(os.path.join(mapping_dir, 'AssignmentConverter.profile.json'))
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
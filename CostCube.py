@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+
+import os
+import json
+import time
+import numpy as np
+import Profiler
+
+# Memory-mapped cost cube shared between analysis processes.
+# The cells x intervals costs (and optionally the cells x intervals x levels costs) are written as .npy files
+# with a small JSON index of the timestamps, resolution and rank count. Readers attach read-only with
+# np.load(mmap_mode='r'), so they parse nothing and share the page cache instead of holding private copies.
+# On disk the cube is interval-major, (intervals, cells) and (intervals, levels, cells), so each interval is
+# written as one contiguous block; attachCostCube returns transposed views in the cells-first layout.
+# Step counts are stored as float32, which is exact for counts up to 2^24.
+# Each publish writes data files named by a new generation, which only its index points to, so a reader never pairs
+# an index with the arrays of another publish. The previous generation is kept for readers that already read its
+# index, older ones are removed.
+
+# File names of the published cube
+COST_CUBE_FILE = 'CostCube.npy'
+LEVEL_CUBE_FILE = 'LevelCube.npy'
+INDEX_FILE = 'CostCube.json'
+
+# Suffix of the files while they are being written
+TEMP_SUFFIX = '.tmp'
+
+# Layout of the arrays on disk
+LAYOUT = 'interval-major'
+
+# Name of a cube file for a generation, as 'CostCube.<generation>.npy'
+def generationFile(file: str, generation: str) -> str:
+    name, ext = os.path.splitext(file)
+    return '{}.{}{}'.format(name, generation, ext)
+
+# Read the index of a published cost cube, or None if there is none
+def readIndex(directory: str) -> dict | None:
+    file = os.path.join(directory, INDEX_FILE)
+    if not os.path.exists(file):
+        return None
+    with open(file, 'r') as f:
+        return json.load(f)
+
+# Writes the cost cube one interval at a time, publishing it atomically on close
+class CostCubeWriter:
+    def __init__(self, directory: str, timestamps: list[str], cells: int, resolution: int,
+                 num_ranks: int | None = None, layers: int | None = None, dtype=np.float32):
+        self.directory = directory
+        self.timestamps = list(timestamps)
+        self.cells = cells
+        self.resolution = resolution
+        self.num_ranks = num_ranks
+        self.layers = layers
+        os.makedirs(directory, exist_ok=True)
+        self.generation = '{:x}'.format(time.time_ns())
+        self.costFile = generationFile(COST_CUBE_FILE, self.generation)
+        self.levelFile = generationFile(LEVEL_CUBE_FILE, self.generation)
+
+        # write to temporary files so attached readers never see a partial cube
+        self.costs = np.lib.format.open_memmap(self.path(self.costFile) + TEMP_SUFFIX, mode='w+',
+                                               dtype=dtype, shape=(len(self.timestamps), cells))
+        self.levels = None
+        if layers is not None:
+            self.levels = np.lib.format.open_memmap(self.path(self.levelFile) + TEMP_SUFFIX, mode='w+',
+                                                    dtype=dtype, shape=(len(self.timestamps), layers, cells))
+
+    # Path of a cube file in the output directory
+    def path(self, file: str) -> str:
+        return os.path.join(self.directory, file)
+
+    # Write the column costs and optionally the (layers, cells) level costs of an interval as contiguous blocks
+    def write(self, interval: int, costs: np.ndarray, levelCosts: np.ndarray | None = None):
+        with Profiler.stage('mmap'):
+            self.costs[interval] = costs
+            if self.levels is not None and levelCosts is not None:
+                self.levels[interval] = levelCosts
+
+    # Flush the cube, move it into place, write the index and remove the generations before the previous one
+    def close(self):
+        with Profiler.stage('mmap'):
+            previous = readIndex(self.directory)
+            files = {'costs': self.costFile}
+            self.costs.flush()
+            del self.costs
+            os.replace(self.path(self.costFile) + TEMP_SUFFIX, self.path(self.costFile))
+            if self.levels is not None:
+                files['levels'] = self.levelFile
+                self.levels.flush()
+                del self.levels
+                os.replace(self.path(self.levelFile) + TEMP_SUFFIX, self.path(self.levelFile))
+
+            # write the index last, it is what readers look for
+            index = {
+                'timestamps': self.timestamps,
+                'resolution': self.resolution,
+                'cells': self.cells,
+                'num_ranks': self.num_ranks,
+                'layers': self.layers,
+                'layout': LAYOUT,
+                'generation': self.generation,
+                'files': files,
+            }
+            with open(self.path(INDEX_FILE) + TEMP_SUFFIX, 'w') as f:
+                json.dump(index, f, indent=2)
+            os.replace(self.path(INDEX_FILE) + TEMP_SUFFIX, self.path(INDEX_FILE))
+
+            # readers may still attach through the previous index, any other cube file is stale
+            keep = set(files.values())
+            if previous is not None:
+                keep |= set(previous['files'].values())
+            stems = tuple(os.path.splitext(file)[0] + '.' for file in [COST_CUBE_FILE, LEVEL_CUBE_FILE])
+            for file in os.listdir(self.directory):
+                if file.startswith(stems) and file.endswith('.npy') and file not in keep:
+                    os.remove(self.path(file))
+        print('Cost cube published to \'{}\'.'.format(self.directory))
+
+# Publish a complete (cells, intervals) cost array and optional (cells, intervals, layers) level array
+def publishCostCube(directory: str, timestamps: list[str], costs: np.ndarray, resolution: int,
+                    num_ranks: int | None = None, levelCosts: np.ndarray | None = None):
+    layers = levelCosts.shape[2] if levelCosts is not None else None
+    writer = CostCubeWriter(directory, timestamps, costs.shape[0], resolution, num_ranks, layers)
+    for interval in range(len(timestamps)):
+        writer.write(interval, costs[:, interval], levelCosts[:, interval, :].T if levelCosts is not None else None)
+    writer.close()
+
+# Attach to a published cost cube read-only without copying
+# @return: the index, the (cells, intervals) costs and the (cells, intervals, layers) level costs or None
+# @note: the arrays are transposed views of the interval-major files, so cube[:, interval] is contiguous
+def attachCostCube(directory: str) -> tuple[dict, np.ndarray, np.ndarray | None]:
+    index = readIndex(directory)
+    if index is None:
+        raise FileNotFoundError('No cost cube published in \'{}\'.'.format(directory))
+    if index.get('layout') != LAYOUT:
+        raise ValueError('Cost cube layout {} is not {}.'.format(index.get('layout'), LAYOUT))
+    costs = np.load(os.path.join(directory, index['files']['costs']), mmap_mode='r')
+    if costs.shape != (len(index['timestamps']), index['cells']):
+        raise ValueError('Cost cube shape {} does not match its index.'.format(costs.shape))
+    levels = None
+    if 'levels' in index['files']:
+        levels = np.load(os.path.join(directory, index['files']['levels']), mmap_mode='r')
+        if levels.shape != (len(index['timestamps']), index['layers'], index['cells']):
+            raise ValueError('Level cube shape {} does not match its index.'.format(levels.shape))
+        levels = levels.transpose(2, 0, 1)
+    return index, costs.T, levels
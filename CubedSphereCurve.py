@@ -0,0 +1,210 @@
+#!/usr/bin/python3
+
+import os
+import sys
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+import Profiler
+import Flags
+
+# Space-filling-curve ordering of the cubed sphere cells.
+# Cells are indexed face-major everywhere, as face * res * res + y * res + x, so contiguous index ranges are
+# strips rather than compact patches. This orders the cells of each face along a Hilbert (or Morton) curve and
+# concatenates the faces in order, giving a forward permutation (curve position -> cell) and its inverse
+# (cell -> curve position). Contiguous curve segments are then spatially compact partitions.
+# @note: the curve restarts on each face, so compactness is only guaranteed within a face
+# @note: resolutions that are not powers of two use the curve of the enclosing power of two, skipping absent cells
+
+# Input argument enumeration
+class InputArg:
+    PROGRAM_NAME = 0
+    TOTAL_STEPS_FILE = 1
+    NUM_RANKS = 2
+    OUTPUT_DIRECTORY = 3
+    LENGTH = 4
+
+# Error code enumeration
+class ErrorCode:
+    SUCCESS = 0
+    INVALID_ARGUMENTS = 1
+    FILE_NOT_FOUND = 2
+    ASSERTION_FAILED = -1
+
+# Supported curves
+CURVES = ['hilbert', 'morton']
+
+# Number of faces of the cubed sphere
+FACES = 6
+
+# Hilbert curve position of each (x, y) on a 2^order by 2^order grid
+def hilbertIndex(x: np.ndarray, y: np.ndarray, order: int) -> np.ndarray:
+    x = x.astype(np.int64).copy()
+    y = y.astype(np.int64).copy()
+    d = np.zeros_like(x)
+    n = 1 << order
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant so the sub-curve is in the standard orientation
+        flip = ~ry & rx
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        swap = ~ry
+        x, y = np.where(swap, y, x), np.where(swap, x, y)
+        s >>= 1
+    return d
+
+# Morton (Z-order) curve position of each (x, y), interleaving the bits of x and y
+def mortonIndex(x: np.ndarray, y: np.ndarray, order: int) -> np.ndarray:
+    x = x.astype(np.int64)
+    y = y.astype(np.int64)
+    d = np.zeros_like(x)
+    for bit in range(order):
+        d |= ((x >> bit) & 1) << (2 * bit)
+        d |= ((y >> bit) & 1) << (2 * bit + 1)
+    return d
+
+# Order of the cells of one face along the curve, as flat y * res + x indices
+def faceOrder(resolution: int, curve: str = 'hilbert') -> np.ndarray:
+    if curve not in CURVES:
+        raise ValueError('Unknown curve {}, expected any of {}.'.format(curve, CURVES))
+    order = max(int(np.ceil(np.log2(resolution))), 0)
+    y, x = np.divmod(np.arange(resolution * resolution), resolution)
+    index = hilbertIndex(x, y, order) if curve == 'hilbert' else mortonIndex(x, y, order)
+    return np.argsort(index, kind='stable')
+
+# Forward and inverse permutations of all cells along the curve, cached per resolution and curve
+# @return: order, the cell at each curve position, and rank, the curve position of each cell
+# @note: pass a cache directory to also keep the permutations on disk across runs
+@lru_cache(maxsize=None)
+def curveOrder(resolution: int, curve: str = 'hilbert', cache_dir: str | None = None) -> tuple[np.ndarray, np.ndarray]:
+    file = None
+    if cache_dir is not None:
+        file = os.path.join(cache_dir, 'CurveOrder_c{}_{}.npy'.format(resolution, curve))
+        if os.path.exists(file):
+            order = np.load(file)
+            order.setflags(write=False)
+            return order, inversePermutation(order)
+
+    with Profiler.stage('curve'):
+        cells_per_face = resolution * resolution
+        face = faceOrder(resolution, curve)
+        order = (np.arange(FACES).reshape(-1, 1) * cells_per_face + face).flatten()
+    order.setflags(write=False)
+
+    if file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.save(file, order)
+    return order, inversePermutation(order)
+
+# Inverse of a permutation
+def inversePermutation(order: np.ndarray) -> np.ndarray:
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    rank.setflags(write=False)
+    return rank
+
+# Reorder a per cell array (cells along the given axis) from face-major to curve order
+def toCurveOrder(array: np.ndarray, order: np.ndarray, axis: int = 0) -> np.ndarray:
+    return np.take(array, order, axis=axis)
+
+# Reorder a per cell array (cells along the given axis) from curve order back to face-major
+def fromCurveOrder(array: np.ndarray, rank: np.ndarray, axis: int = 0) -> np.ndarray:
+    return np.take(array, rank, axis=axis)
+
+# Resolution of the cubed sphere from the number of cells
+def resolutionOf(cells: int) -> int:
+    resolution = int(round(np.sqrt(cells // FACES)))
+    if FACES * resolution * resolution != cells:
+        raise ValueError('{} cells is not a cubed sphere.'.format(cells))
+    return resolution
+
+# Partition the cells into contiguous curve segments of about equal cost, one per rank
+# @return: the face-major assignment of each cell to a rank
+# @note: every rank gets at least one cell, so there cannot be more ranks than cells
+def curvePartition(costs: np.ndarray, num_ranks: int, order: np.ndarray) -> np.ndarray:
+    cells = len(order)
+    if num_ranks > cells:
+        raise ValueError('{} ranks is more than the {} cells.'.format(num_ranks, cells))
+    costs = toCurveOrder(costs.astype(np.float64), order)
+    if costs.sum() <= 0:
+        # no cost information, split the curve into equal cell counts
+        costs = np.ones_like(costs)
+    # cost before each cut position along the curve, from 0 to the total
+    prefix = np.concatenate([[0.0], np.cumsum(costs)])
+    # cut where the prefix is closest to each equal share of the total
+    k = np.arange(1, num_ranks)
+    targets = prefix[-1] * k / num_ranks
+    cuts = np.searchsorted(prefix, targets)
+    cuts -= (targets - prefix[cuts - 1]) < (prefix[cuts] - targets)
+    # keep at least one cell per segment, cuts - k must be non-decreasing and within 0 to cells - num_ranks
+    cuts = np.maximum.accumulate(np.clip(cuts - k, 0, cells - num_ranks)) + k
+    parts = np.searchsorted(cuts, np.arange(cells), side='right')
+    assignment = np.empty_like(parts)
+    assignment[order] = parts
+    return assignment
+
+# Main function
+def main():
+    # Enable profiling if requested
+    sys.argv = Profiler.parseFlag(sys.argv)
+
+    # Check if there are enough arguments
+    if len(sys.argv) < InputArg.LENGTH:
+        print('Usage: {} <total_steps_file> <num_ranks> <output_directory> [--curve={}] [--cache=<dir>]'.format(sys.argv[InputArg.PROGRAM_NAME], '|'.join(CURVES)))
+        sys.exit(ErrorCode.INVALID_ARGUMENTS)
+
+    # Optionally check for flags
+    flags = sys.argv[InputArg.LENGTH:]
+    # Curve flag: '--curve=hilbert' or '--curve=morton'
+    curve = Flags.getFlagValue(flags, None, '--curve', 'hilbert')
+    if curve not in CURVES:
+        print('Error: Unknown curve \'{}\', expected any of {}.'.format(curve, CURVES))
+        sys.exit(ErrorCode.INVALID_ARGUMENTS)
+    # Cache flag: '--cache=<dir>', keep the curve permutation on disk across runs
+    cache_dir = Flags.getFlagValue(flags, None, '--cache')
+
+    # Check the number of ranks
+    if not sys.argv[InputArg.NUM_RANKS].isdigit() or int(sys.argv[InputArg.NUM_RANKS]) <= 0:
+        print('Error: number of ranks must be a positive integer, got \'{}\''.format(sys.argv[InputArg.NUM_RANKS]))
+        sys.exit(ErrorCode.INVALID_ARGUMENTS)
+    num_ranks = int(sys.argv[InputArg.NUM_RANKS])
+
+    # Check if the total steps file exists
+    total_steps_file = sys.argv[InputArg.TOTAL_STEPS_FILE]
+    if not os.path.exists(total_steps_file):
+        print('Error: total steps file not found')
+        sys.exit(ErrorCode.FILE_NOT_FOUND)
+    output_dir = sys.argv[InputArg.OUTPUT_DIRECTORY]
+
+    # Read the total steps file
+    with Profiler.stage('read', total_steps_file):
+        total_steps = pd.read_csv(total_steps_file, index_col=0)
+    try:
+        resolution = resolutionOf(total_steps.shape[0])
+    except ValueError as e:
+        print('Error: {}'.format(e))
+        sys.exit(ErrorCode.ASSERTION_FAILED)
+    if num_ranks > total_steps.shape[0]:
+        print('Error: {} ranks is more than the {} cells'.format(num_ranks, total_steps.shape[0]))
+        sys.exit(ErrorCode.INVALID_ARGUMENTS)
+    order, _ = curveOrder(resolution, curve, cache_dir)
+
+    # Partition each interval and write it as an assignment file for AssignmentConverter
+    os.makedirs(output_dir, exist_ok=True)
+    for interval in range(total_steps.shape[1]):
+        with Profiler.stage('partition'):
+            assignment = curvePartition(total_steps.iloc[:, interval].values, num_ranks, order)
+        file = os.path.join(output_dir, 'interval_{}.assignment'.format(interval))
+        with Profiler.stage('write', file):
+            np.savetxt(file, assignment.reshape(FACES * resolution, resolution), fmt='%d', delimiter=',')
+    print('Partitioned {} intervals along the {} curve into \'{}\'.'.format(total_steps.shape[1], curve, output_dir))
+
+    # Report the profile if enabled
+    Profiler.report(os.path.join(output_dir, 'CubedSphereCurve.profile.json'))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,13 @@
+#!/usr/bin/python3
+
+# Command line flag parsing shared by the scripts.
+
+# Get the value of a flag given as '-x value', '--long value' or '--long=value'
+# @note: with separate=False only '--long=value' is a value, for switches that also take an optional value
+def getFlagValue(flags: list[str], short: str | None, long: str, default: str | None = None, separate: bool = True) -> str | None:
+    for i, flag in enumerate(flags):
+        if flag.startswith(long + '='):
+            return flag[len(long) + 1:]
+        if separate and flag in (short, long) and i + 1 < len(flags):
+            return flags[i + 1]
+    return default
@@ -4,6 +4,9 @@ import os
 import sys
 import numpy as np
 import pandas as pd
+import Profiler
+import Flags
+import Topology
 
 # Input argument enumeration
 class InputArg:
@@ -20,11 +23,40 @@ class ErrorCode:
     FILE_NOT_FOUND = 2
     FILE_ALREADY_EXISTS = 3
 
-if __name__ == '__main__':
+# Aggregate the KPP steps per rank per interval as the maximum over the cells on each rank
+def aggregateRankSteps(ranks: np.ndarray, total_steps: np.ndarray, num_ranks: int) -> np.ndarray:
+    total_kpp_steps = np.zeros((num_ranks, total_steps.shape[1]))
+    np.maximum.at(total_kpp_steps, ranks, total_steps)
+    return total_kpp_steps
+
+# Create a DataFrame for the KPP steps per rank per interval
+def rankStepsToDataFrame(total_kpp_steps: np.ndarray) -> pd.DataFrame:
+    num_ranks, num_intervals = total_kpp_steps.shape
+    columns = ['Rank'] + [f'Interval_{j}' for j in range(num_intervals)]
+    data = np.hstack((np.arange(num_ranks).reshape(-1, 1), total_kpp_steps))
+    return pd.DataFrame(data, columns=columns)
+
+def main():
+    # Enable profiling if requested
+    sys.argv = Profiler.parseFlag(sys.argv)
+
     # Check if there are enough arguments
     if len(sys.argv) < InputArg.ARG_LENGTH:
-        print('Usage: {} <rank_index_file> <total_steps_file> <output_file>'.format(sys.argv[InputArg.PROGRAM_NAME]))
+        print('Usage: {} <rank_index_file> <total_steps_file> <output_file> [--ranks=N] [--ranks-per-node=N | --hostfile=file]'.format(sys.argv[InputArg.PROGRAM_NAME]))
+        print('  with a topology, also writes the summed load per rank, per node and the imbalance as <output>_Ranks.csv, <output>_Nodes.csv and <output>_Imbalance.csv')
+        sys.exit(ErrorCode.INVALID_ARGUMENTS)
+
+    # Optionally check for flags
+    flags = sys.argv[InputArg.ARG_LENGTH:]
+    # Ranks flag: '--ranks=N', number of ranks, defaults to the ranks in the rank index file
+    ranks_flag = Flags.getFlagValue(flags, None, '--ranks')
+    # Topology flags: '--ranks-per-node=N' or '--hostfile=file', aggregate the load per node
+    ranks_per_node = Flags.getFlagValue(flags, None, '--ranks-per-node')
+    hostfile = Flags.getFlagValue(flags, None, '--hostfile')
+    if ranks_flag is not None and (not ranks_flag.isdigit() or int(ranks_flag) <= 0):
+        print('Error: number of ranks must be a positive integer, got \'{}\''.format(ranks_flag))
         sys.exit(ErrorCode.INVALID_ARGUMENTS)
+    Topology.checkNodeFlags(ranks_per_node, hostfile)
 
     # Check if the rank index file exists
     if not os.path.exists(sys.argv[InputArg.RANK_INDEX_FILE]):
@@ -45,28 +77,56 @@ if __name__ == '__main__':
             sys.exit(ErrorCode.FILE_ALREADY_EXISTS)
 
     # Read the rank index file
-    rank_index = pd.read_csv(sys.argv[InputArg.RANK_INDEX_FILE], header='infer')
-    num_ranks = 24
+    with Profiler.stage('read', sys.argv[InputArg.RANK_INDEX_FILE]):
+        rank_index = pd.read_csv(sys.argv[InputArg.RANK_INDEX_FILE], header='infer')
+    ranks = rank_index['KppRank'].values
+    num_ranks = int(ranks.max()) + 1
+    if ranks_flag is not None:
+        if int(ranks_flag) < num_ranks:
+            print('Error: --ranks={} is less than the {} ranks in the rank index file'.format(ranks_flag, num_ranks))
+            sys.exit(ErrorCode.INVALID_ARGUMENTS)
+        num_ranks = int(ranks_flag)
+
+    # Map the ranks to nodes if a topology was given
+    node_of_rank, node_names = Topology.nodeMap(num_ranks, ranks_per_node, hostfile)
+
     # Read the total steps file
-    total_steps = pd.read_csv(sys.argv[InputArg.TOTAL_STEPS_FILE], header='infer')
+    with Profiler.stage('read', sys.argv[InputArg.TOTAL_STEPS_FILE]):
+        total_steps = pd.read_csv(sys.argv[InputArg.TOTAL_STEPS_FILE], header='infer')
     num_cells = total_steps.shape[0]
-    num_intervals = total_steps.shape[1] - 1
 
     # Compute the total KPP steps per rank per interval
-    total_kpp_steps = np.zeros((num_ranks, num_intervals))
-    
-    # Compute the total KPP steps per rank per interval
-    for i in range(num_cells):
-        print('Aggregating KPP steps for cell {}/{}'.format(i + 1, num_cells), end='\r')
-        rank = rank_index['KppRank'][i]
-        for j in range(num_intervals):
-            total_kpp_steps[rank, j] = max(total_kpp_steps[rank, j], total_steps.iloc[i, j + 1])
+    with Profiler.stage('aggregate'):
+        total_kpp_steps = aggregateRankSteps(ranks, total_steps.iloc[:, 1:].values, num_ranks)
     print('Aggregated KPP steps for {} cells'.format(num_cells))
     
     # Create a DataFrame for the total KPP steps per rank per interval
-    columns = ['Rank'] + [f'Interval_{j}' for j in range(num_intervals)]
-    data = np.hstack((np.arange(num_ranks).reshape(-1, 1), total_kpp_steps))
-    df = pd.DataFrame(data, columns=columns)
+    df = rankStepsToDataFrame(total_kpp_steps)
     
     # Save the DataFrame to a CSV file
-    df.to_csv(sys.argv[InputArg.OUTPUT_FILE], index=False)
\ No newline at end of file
+    with Profiler.stage('write', sys.argv[InputArg.OUTPUT_FILE]):
+        df.to_csv(sys.argv[InputArg.OUTPUT_FILE], index=False)
+
+    # Aggregate the load per rank, per node and globally and save the rank load, node load and imbalance
+    # @note: unlike the output file, which keeps the maximum column of each rank, these are sums over the cells
+    if node_of_rank is not None:
+        with Profiler.stage('topology'):
+            load = Topology.aggregateLoad(total_steps.iloc[:, 1:].values, ranks, node_of_rank, num_ranks)
+        output = os.path.splitext(sys.argv[InputArg.OUTPUT_FILE])[0]
+        rankFile = '{}_Ranks.csv'.format(output)
+        with Profiler.stage('write', rankFile):
+            Topology.rankLoadToDataFrame(load).to_csv(rankFile, index=False)
+        nodeFile = '{}_Nodes.csv'.format(output)
+        with Profiler.stage('write', nodeFile):
+            Topology.nodeLoadToDataFrame(load, node_names).to_csv(nodeFile, index=False)
+        imbalanceFile = '{}_Imbalance.csv'.format(output)
+        with Profiler.stage('write', imbalanceFile):
+            Topology.imbalanceToDataFrame(load).to_csv(imbalanceFile, index=False)
+        print('Maximum inter-node imbalance: {:.3f}'.format(load['inter_node_imbalance'].max()))
+        print('Maximum intra-node imbalance: {:.3f}'.format(load['intra_node_imbalance'].max()))
+
+    # Report the profile if enabled
+    Profiler.report('{}.profile.json'.format(sys.argv[InputArg.OUTPUT_FILE]))
+
+if __name__ == '__main__':
+    main()
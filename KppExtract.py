@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+
+import json
+import numpy as np
+import Profiler
+
+# Configurable extraction of several KPP diagnostics and reductions in a single pass over the files.
+# A spec is a list of variable and reduction pairs, given as 'KppTotSteps:column,KppTotSteps:level,KppRejSteps:max'
+# or as a JSON file mapping each variable to its list of reductions. The variables are read through the same
+# KppDiagsSeries reader as the total steps, so every file is opened once and each variable is read once, as stored,
+# since only KppTotSteps is rounded up. All reductions are stored per interval in a single .npz store keyed by
+# '<variable>.<reduction>'.
+
+# Supported reductions and the shape they produce per interval
+# column: sum over the levels of each cell, (cells,)
+# level: sum over the cells of each level, (levels,)
+# max: maximum over the levels of each cell, (cells,)
+# hist: histogram of the column sums of the cells, (bins,)
+REDUCTIONS = ['column', 'level', 'max', 'hist']
+
+# Default number of histogram bins
+HIST_BINS = 32
+
+# File name of the store in the KPP diagnostics directory
+EXTRACT_FILE = 'Extract.npz'
+
+# A reduction of a variable, with the histogram edges for 'hist'
+class Reduction:
+    def __init__(self, variable: str, kind: str, bins: int = HIST_BINS, limits: tuple[float, float] | None = None):
+        if kind not in REDUCTIONS:
+            raise ValueError('Unknown reduction {}, expected any of {}.'.format(kind, REDUCTIONS))
+        if bins <= 0:
+            raise ValueError('Histogram of {} needs a positive number of bins, got {}.'.format(variable, bins))
+        if limits is not None and limits[0] >= limits[1]:
+            raise ValueError('Histogram of {} needs low < high, got {}:{}.'.format(variable, limits[0], limits[1]))
+        self.variable = variable
+        self.kind = kind
+        self.bins = bins
+        self.limits = limits
+        self.edges = None
+
+    # Key of the reduction in the output store
+    @property
+    def key(self) -> str:
+        return '{}.{}'.format(self.variable, self.kind)
+
+    # Apply the reduction to the (levels, cells) data of one interval
+    def apply(self, data: np.ndarray) -> np.ndarray:
+        if self.kind == 'column':
+            return data.sum(axis=0, dtype=np.float64)
+        if self.kind == 'level':
+            return data.sum(axis=1, dtype=np.float64)
+        if self.kind == 'max':
+            return data.max(axis=0).astype(np.float64)
+        columns = data.sum(axis=0, dtype=np.float64)
+        # fix the edges on the first interval so every interval shares them
+        if self.edges is None:
+            low, high = self.limits if self.limits is not None else (0.0, 2 * max(columns.max(), 1.0))
+            self.edges = np.linspace(low, high, self.bins + 1)
+        # count the values outside of the edges in the first and last bins
+        counts, _ = np.histogram(np.clip(columns, self.edges[0], self.edges[-1]), self.edges)
+        return counts
+
+# Parse a reduction given as 'kind', 'hist=bins' or 'hist=low:high:bins'
+def parseReduction(variable: str, text: str) -> Reduction:
+    kind, _, option = text.partition('=')
+    if kind != 'hist' or len(option) == 0:
+        return Reduction(variable, kind)
+    parts = option.split(':')
+    if len(parts) == 3:
+        return Reduction(variable, kind, int(parts[2]), (float(parts[0]), float(parts[1])))
+    return Reduction(variable, kind, int(parts[0]))
+
+# Parse an extraction spec from a 'variable:reduction,...' string or a JSON file of {variable: [reduction, ...]}
+def parseSpec(spec: str) -> list[Reduction]:
+    if spec.endswith('.json'):
+        with open(spec, 'r') as f:
+            reductions = [parseReduction(variable, text) for variable, texts in json.load(f).items() for text in texts]
+    else:
+        reductions = []
+        for item in spec.split(','):
+            variable, _, text = item.partition(':')
+            reductions.append(parseReduction(variable, text or 'column'))
+    # each reduction is stored under its key, so a key can only be extracted once
+    keys = [reduction.key for reduction in reductions]
+    duplicates = sorted(set(key for key in keys if keys.count(key) > 1))
+    if len(duplicates) > 0:
+        raise ValueError('Duplicate reductions {}.'.format(duplicates))
+    return reductions
+
+# Variables read by a spec, in order of first use
+def specVariables(spec: list[Reduction]) -> list[str]:
+    return list(dict.fromkeys(reduction.variable for reduction in spec))
+
+# Collects the reductions of every interval into one store
+class ExtractStore:
+    def __init__(self, spec: list[Reduction], timestamps: list[str]):
+        self.spec = spec
+        self.timestamps = list(timestamps)
+        self.results = {}
+
+    # Apply the spec to the (levels, cells) variables of an interval and store the results
+    def add(self, interval: int, variables: dict[str, np.ndarray]):
+        with Profiler.stage('extract'):
+            for reduction in self.spec:
+                result = reduction.apply(variables[reduction.variable])
+                if reduction.key not in self.results:
+                    self.results[reduction.key] = np.zeros((len(self.timestamps),) + result.shape, dtype=result.dtype)
+                self.results[reduction.key][interval] = result
+
+    # Arrays of the store, per cell results as (cells, intervals) like TotalSteps.csv and the others as (intervals, ...)
+    def arrays(self) -> dict[str, np.ndarray]:
+        arrays = {'timestamps': np.array(self.timestamps)}
+        for reduction in self.spec:
+            result = self.results[reduction.key]
+            arrays[reduction.key] = result.T if reduction.kind in ['column', 'max'] else result
+            if reduction.edges is not None:
+                arrays['{}.edges'.format(reduction.key)] = reduction.edges
+        return arrays
+
+    # Save the store
+    def save(self, file: str):
+        writeExtract(file, self.arrays())
+
+# Write the arrays of a store to a single .npz file
+def writeExtract(file: str, arrays: dict[str, np.ndarray]):
+    with Profiler.stage('write', file):
+        np.savez(file, **arrays)
+    keys = [key for key in arrays if key != 'timestamps' and not key.endswith('.edges')]
+    print('Extracted {} to \'{}\'.'.format(', '.join(keys), file))
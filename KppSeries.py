@@ -0,0 +1,213 @@
+#!/usr/bin/python3
+
+import os
+from collections import deque
+import numpy as np
+import netCDF4 as nc
+import Profiler
+
+# Lazy view of a variable over a directory of KPP diagnostics files as a (time, lev, nf, Y, X) array.
+# Nothing is read until indexed or reduced, and reductions over time or level run one chunk of files at a time.
+# Other variables can be read alongside the series variable in the same open, only the series variable is rounded up.
+# @note: assumes every file holds a single time step, as written by GEOS-Chem for 'GEOSChem.KppDiags.*.nc4'
+
+# Check if a file is a KPP diagnostics file
+def isKppDiagsFile(file: str) -> bool:
+    return file.startswith('GEOSChem.KppDiags.') and file.endswith('.nc4')
+
+# Convert the directory named 'GEOSChem.KppDiags.*.nc4' to the timestamp
+# @note: assumes that the file name is in the format 'GEOSChem.KppDiags.*.nc4'
+def convertKppDiagsFileToTimestamp(file: str) -> str:
+    # split the file name into parts
+    parts = os.path.basename(file).split('.')
+    # extract the timestamp from the parts
+    timestamp = parts[2]
+    return timestamp
+
+# Find all files in directory named 'GEOSChem.KppDiags.*.nc4'
+def findKppDiagsFiles(directory) -> dict[str, str]:
+    # dictionary to store the files by timestamp
+    files = {}
+    for filename in os.listdir(directory):
+        if isKppDiagsFile(filename):
+            files[convertKppDiagsFileToTimestamp(filename)] = os.path.join(directory, filename)
+    # sort files by timestamp
+    files = dict(sorted(files.items()))
+    return files
+
+class KppDiagsSeries:
+    # Create a view over a directory or a dictionary of files by timestamp
+    def __init__(self, path: str | dict[str, str], variable: str = 'KppTotSteps', chunk: int = 1, roundup: bool = True):
+        if isinstance(path, dict):
+            self.files = dict(sorted(path.items()))
+        elif os.path.isdir(path):
+            self.files = findKppDiagsFiles(path)
+        else:
+            self.files = {convertKppDiagsFileToTimestamp(path): path}
+        if len(self.files) == 0:
+            raise FileNotFoundError('No KPP diagnostics files found in \'{}\'.'.format(path))
+        self.timestamps = list(self.files.keys())
+        self.variable = variable
+        self.chunk = chunk
+        self.roundup = roundup
+        # shape of a single time step and keys of the files, taken from the first file opened
+        self._stepShape = None
+        self._keys = None
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    # Record the shape of a time step and the keys from an open file, checking that it has the series variable
+    def inspect(self, f: nc.Dataset, file: str):
+        if self.variable not in f.variables:
+            raise KeyError('Missing key {} in \'{}\'.'.format(self.variable, file))
+        if self._stepShape is None:
+            self._stepShape = f.variables[self.variable].shape[1:]
+            self._keys = list(f.variables.keys())
+
+    # Open the first file for its shape and keys unless a read has already recorded them
+    def inspectFirst(self):
+        if self._stepShape is None:
+            file = self.files[self.timestamps[0]]
+            with Profiler.stage('open', file), nc.Dataset(file, 'r') as f:
+                self.inspect(f, file)
+
+    # Shape of a single (lev, nf, Y, X) time step
+    @property
+    def stepShape(self) -> tuple[int, ...]:
+        self.inspectFirst()
+        return self._stepShape
+
+    # Keys of the variables in the files
+    @property
+    def keys(self) -> list[str]:
+        self.inspectFirst()
+        return self._keys
+
+    # Shape of the virtual (time, lev, nf, Y, X) array
+    @property
+    def shape(self) -> tuple[int, ...]:
+        return (len(self.timestamps),) + self.stepShape
+
+    # Resolution of the cubed sphere
+    @property
+    def resolution(self) -> int:
+        return self.stepShape[-1]
+
+    # Number of levels
+    @property
+    def levels(self) -> int:
+        return self.stepShape[0]
+
+    # Number of cells per level, flattened face-major
+    @property
+    def cells(self) -> int:
+        return int(np.prod(self.stepShape[1:]))
+
+    # Read a single time step, optionally restricted to an index over (lev, nf, Y, X)
+    def readStep(self, timestamp: str, index: tuple = ()) -> np.ndarray:
+        return self.readVariables(timestamp, [], index)[self.variable]
+
+    # Read the series variable and other variables of a single time step in one open,
+    # optionally restricted to an index over (lev, nf, Y, X)
+    # @note: missing variables raise a KeyError, unless they are optional, in which case they are skipped
+    def readVariables(self, timestamp: str, variables: list[str], index: tuple = (), optional: list[str] = []) -> dict[str, np.ndarray]:
+        file = self.files[timestamp]
+        result = {}
+        with Profiler.stage('open', file):
+            f = nc.Dataset(file, 'r')
+        with f:
+            self.inspect(f, file)
+            missing = [key for key in variables if key not in f.variables]
+            if len(missing) > 0:
+                raise KeyError('Missing keys {} in \'{}\'.'.format(missing, file))
+            for key in dict.fromkeys([self.variable] + variables + [key for key in optional if key in f.variables]):
+                # read and decompress only the requested part of the variable
+                with Profiler.stage('read', file):
+                    var = f.variables[key][(0,) + index]
+                # convert the masked array to a ndarray
+                if hasattr(var, 'mask'):
+                    var = var.filled()
+                # round up the series variable if needed, the others are read as stored
+                if self.roundup and key == self.variable:
+                    var = np.ceil(var)
+                result[key] = var
+        return result
+
+    # Convert a time key (index, slice or timestamp) to the list of timestamps it selects
+    def selectTimestamps(self, key: int | slice | str) -> list[str]:
+        if isinstance(key, str):
+            if key not in self.files:
+                raise KeyError('Timestamp {} not found.'.format(key))
+            return [key]
+        if isinstance(key, slice):
+            return self.timestamps[key]
+        return [self.timestamps[key]]
+
+    # Index the virtual array, reading only the selected time steps and the selected part of each
+    def __getitem__(self, key) -> np.ndarray:
+        if not isinstance(key, tuple):
+            key = (key,)
+        timestamps = self.selectTimestamps(key[0])
+        steps = [self.readStep(timestamp, key[1:]) for timestamp in timestamps]
+        # drop the time axis when a single time step was selected by index or timestamp
+        if not isinstance(key[0], slice):
+            return steps[0]
+        return np.stack(steps)
+
+    # Iterate over the series in chunks of time steps, yielding the timestamps and the (time, ...) array of each chunk
+    def chunks(self, index: tuple = (), chunk: int | None = None):
+        chunk = chunk or self.chunk
+        for start in range(0, len(self.timestamps), chunk):
+            timestamps = self.timestamps[start:start + chunk]
+            yield timestamps, np.stack([self.readStep(timestamp, index) for timestamp in timestamps])
+
+    # Apply a reduction to each chunk and concatenate the results along time
+    # @note: func receives a (time, ...) chunk and must return an array with the same leading time axis
+    def reduce(self, func, index: tuple = (), chunk: int | None = None) -> np.ndarray:
+        results = []
+        for timestamps, data in self.chunks(index, chunk):
+            with Profiler.stage('reduce'):
+                results.append(func(data))
+        return np.concatenate(results)
+
+    # Sum over the levels of each column, as a (time, cells) array
+    def columnSum(self, layers: int | None = None) -> np.ndarray:
+        return self.reduce(lambda data: data.reshape(data.shape[0], data.shape[1], -1).sum(axis=1, dtype=np.float64),
+                           (slice(0, layers),))
+
+    # Sum over the cells of each level, as a (time, lev) array
+    def levelSum(self, layers: int | None = None) -> np.ndarray:
+        return self.reduce(lambda data: data.reshape(data.shape[0], data.shape[1], -1).sum(axis=2, dtype=np.float64),
+                           (slice(0, layers),))
+
+    # Sum over the columns on each rank, as a (time, ranks) array
+    def rankSum(self, ranks: np.ndarray, num_ranks: int | None = None, layers: int | None = None) -> np.ndarray:
+        num_ranks = num_ranks or int(ranks.max()) + 1
+        def sumRanks(data: np.ndarray) -> np.ndarray:
+            columns = data.reshape(data.shape[0], data.shape[1], -1).sum(axis=1, dtype=np.float64)
+            return np.stack([np.bincount(ranks, weights=column, minlength=num_ranks) for column in columns])
+        return self.reduce(sumRanks, (slice(0, layers),))
+
+    # Rolling sum (or mean) of the column sums over a window of time steps, as a (time - window + 1, cells) array
+    # @note: only the column sums of the current window are kept in memory
+    def rolling(self, window: int, layers: int | None = None, mean: bool = False) -> np.ndarray:
+        if window < 1 or window > len(self.timestamps):
+            raise ValueError('Window {} out of range for {} time steps.'.format(window, len(self.timestamps)))
+        results = np.empty((len(self.timestamps) - window + 1, self.cells))
+        current = deque()
+        total = np.zeros(self.cells)
+        position = 0
+        for timestamps, data in self.chunks((slice(0, layers),)):
+            for step in data:
+                column = step.reshape(step.shape[0], -1).sum(axis=0, dtype=np.float64)
+                current.append(column)
+                total += column
+                if len(current) > window:
+                    total -= current.popleft()
+                if len(current) == window:
+                    results[position] = total
+                    position += 1
+        if mean:
+            results /= window
+        return results
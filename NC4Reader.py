@@ -4,6 +4,7 @@ import os
 import sys
 import pandas as pd
 import netCDF4 as nc
+import Profiler
 
 # Find all files in directory named 'GEOSChem.KppDiags.*.nc4'
 def findKppDiagsFiles(directory):
@@ -17,13 +18,16 @@ def findKppDiagsFiles(directory):
 def readKppDiags(file):
     # dictionary to store the variables
     vars = {}
-    with nc.Dataset(file, 'r') as f:
+    with Profiler.stage('open', file):
+        f = nc.Dataset(file, 'r')
+    with f:
         # keys of the variables to be read
         keys = f.variables.keys()
         # read each variable
         for key in keys:
-            # read the variable
-            var = f.variables[key][:]
+            # read and decompress the variable
+            with Profiler.stage('read', file):
+                var = f.variables[key][:]
             # check if the variable is a masked array
             if hasattr(var, 'mask'):
                 # convert the masked array to a list
@@ -61,6 +65,9 @@ def printToFile(file, variable):
 
 # Main function
 def main():
+    # enable profiling if requested
+    sys.argv = Profiler.parseFlag(sys.argv)
+
     # default directory to be the current directory
     dir = 'KppDiags'
     # check if an argument is passed to the script
@@ -78,7 +85,8 @@ def main():
         return
         
     # find the KPP diagnostics file
-    files = findKppDiagsFiles(dir)
+    with Profiler.stage('find'):
+        files = findKppDiagsFiles(dir)
     # check if any files were found
     if len(files) == 0:
         print('No KPP diagnostics files found in \'{}\'.'.format(dir))
@@ -103,7 +111,12 @@ def main():
         # print each variable to their own file and shape to the console
         for key in vars:
             print('{}: {}'.format(key, vars[key].shape))
-            printToFile('{}/{}.txt'.format(outputDir, key), vars[key])
+            outputFile = '{}/{}.txt'.format(outputDir, key)
+            with Profiler.stage('write', outputFile):
+                printToFile(outputFile, vars[key])
+
+    # report the profile if enabled, next to the output of the last file
+    Profiler.report(os.path.join(outputDir, 'NC4Reader.profile.json'))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,320 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+import Profiler
+import Flags
+import AggKppSteps
+import KppAggregator
+import AssignmentConverter
+import CostCube
+import Topology
+import CubedSphereCurve
+import KppExtract
+import KppSeries
+
+# Runs AggKppSteps, KppAggregator and AssignmentConverter in one process.
+# Arrays are handed between the stages in memory, only the requested artifacts are written,
+# and stages whose inputs are unchanged are loaded from the cache instead of recomputed.
+
+# Input argument enumeration
+class InputArg:
+    PROGRAM_NAME = 0
+    DIRECTORY = 1
+    LENGTH = 2
+
+# Error code enumeration
+class ErrorCode:
+    SUCCESS = 0
+    INVALID_ARGUMENTS = 1
+    FILE_NOT_FOUND = 2
+    KEY_NOT_FOUND = 3
+    ASSERTION_FAILED = -1
+
+# Artifacts that can be written by the pipeline
+class Artifact:
+    TOTAL_STEPS = 'total_steps'
+    RANK_INDEX = 'rank_index'
+    RANK_STEPS = 'rank_steps'
+    MAPPINGS = 'mappings'
+    COST_CUBE = 'cost_cube'
+    DELTA_MAPPINGS = 'delta_mappings'
+    MIGRATION_STATS = 'migration_stats'
+    LOAD_BALANCE = 'load_balance'
+    EXTRACT = 'extract'
+    ALL = [TOTAL_STEPS, RANK_INDEX, RANK_STEPS, MAPPINGS, COST_CUBE, DELTA_MAPPINGS, MIGRATION_STATS, LOAD_BALANCE, EXTRACT]
+    # artifacts derived from the assignments
+    ASSIGNMENTS = [MAPPINGS, DELTA_MAPPINGS, MIGRATION_STATS]
+    DEFAULT = [RANK_STEPS, MAPPINGS]
+
+# Name of the cache directory inside the KPP diagnostics directory
+CACHE_DIR = '.pipeline'
+
+# Prefix of the extracted arrays in the columns stage
+EXTRACT_PREFIX = 'extract:'
+
+# Fingerprint a stage by its name, parameters, input files and upstream fingerprints
+# @note: files are identified by path, size and modification time, not by content
+def fingerprint(stage: str, params: dict, files: list[str] = [], upstream: list[str] = []) -> str:
+    inputs = []
+    for file in files:
+        stat = os.stat(file)
+        inputs.append([os.path.abspath(file), stat.st_size, stat.st_mtime_ns])
+    key = json.dumps([stage, params, inputs, upstream], sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+# Load the cached arrays of a stage if its fingerprint matches, otherwise return None
+def loadCache(cache_dir: str, stage: str, key: str) -> dict[str, np.ndarray] | None:
+    file = os.path.join(cache_dir, '{}.npz'.format(stage))
+    if not os.path.exists(file):
+        return None
+    with Profiler.stage('cache', file), np.load(file) as cached:
+        if str(cached['fingerprint']) != key:
+            return None
+        print('Stage \'{}\' is unchanged, using cache.'.format(stage))
+        return {name: cached[name] for name in cached.files if name != 'fingerprint'}
+
+# Save the arrays of a stage to the cache with its fingerprint
+def saveCache(cache_dir: str, stage: str, key: str, arrays: dict[str, np.ndarray]):
+    os.makedirs(cache_dir, exist_ok=True)
+    file = os.path.join(cache_dir, '{}.npz'.format(stage))
+    with Profiler.stage('cache', file):
+        np.savez(file, fingerprint=key, **arrays)
+
+# Stage 1: column total steps per cell per interval, the rank and index on rank of each cell,
+# and the reductions of the extraction spec if any, all read in a single open per file
+def runColumns(files: dict[str, str], cache_dir: str, force: bool, spec: list[KppExtract.Reduction] = []) -> tuple[str, dict[str, np.ndarray]]:
+    params = {'layers': AggKppSteps.LAYERS, 'extract': [[reduction.key, reduction.bins, reduction.limits] for reduction in spec]}
+    key = fingerprint('columns', params, list(files.values()))
+    cached = None if force else loadCache(cache_dir, 'columns', key)
+    if cached is not None:
+        return key, cached
+
+    # the ranks and indices on rank are read along with the total steps of the first file if available
+    store = KppExtract.ExtractStore(spec, list(files.keys()))
+    costs = []
+    for interval, (timestamp, file, cost, variables) in enumerate(
+            AggKppSteps.readColumnCosts(files, AggKppSteps.LAYERS, KppExtract.specVariables(spec), ['KppRank', 'KppIndexOnRank'])):
+        if interval == 0:
+            ranks = variables['KppRank'][0].astype(int) if 'KppRank' in variables else np.empty(0, dtype=int)
+            if 'KppIndexOnRank' in variables:
+                indices = variables['KppIndexOnRank'][0].astype(int)
+            elif len(ranks) > 0:
+                indices = AssignmentConverter.computeIndexOnRank(ranks)
+            else:
+                indices = np.empty(0, dtype=int)
+        costs.append(cost)
+        if len(spec) > 0:
+            store.add(interval, variables)
+
+    arrays = {'timestamps': np.array(list(files.keys())), 'costs': np.stack(costs, axis=1), 'ranks': ranks, 'indices': indices}
+    if len(spec) > 0:
+        arrays.update({EXTRACT_PREFIX + name: array for name, array in store.arrays().items()})
+    saveCache(cache_dir, 'columns', key, arrays)
+    return key, arrays
+
+# Stage 2: KPP steps per rank per interval
+def runRankSteps(columns: dict[str, np.ndarray], upstream: str, cache_dir: str, force: bool) -> tuple[str, dict[str, np.ndarray]]:
+    key = fingerprint('rank_steps', {}, upstream=[upstream])
+    cached = None if force else loadCache(cache_dir, 'rank_steps', key)
+    if cached is not None:
+        return key, cached
+
+    ranks = columns['ranks']
+    with Profiler.stage('aggregate'):
+        steps = KppAggregator.aggregateRankSteps(ranks, columns['costs'], ranks.max() + 1)
+
+    arrays = {'steps': steps}
+    saveCache(cache_dir, 'rank_steps', key, arrays)
+    return key, arrays
+
+# Stage 3: mapping of each rank and index on rank to target rank per interval
+def runMappings(columns: dict[str, np.ndarray], upstream: str, files: dict[int, str], cache_dir: str, force: bool) -> tuple[str, dict[str, np.ndarray]]:
+    key = fingerprint('mappings', {'intervals': list(files.keys())}, list(files.values()), [upstream])
+    cached = None if force else loadCache(cache_dir, 'mappings', key)
+    if cached is not None:
+        return key, cached
+
+    ranks = columns['ranks']
+    indices = columns['indices']
+    num_ranks = ranks.max() + 1
+    num_indices = indices.max()
+    mappings = np.empty((len(files), num_ranks, num_indices), dtype=int)
+    for interval, file in enumerate(files.values()):
+        assignment = AssignmentConverter.readAssignment(file)
+        # Check if the number of cells in the assignment file matches the number of cells
+        if len(assignment) != len(ranks):
+            print('Error: Number of cells in \'{}\' does not match number of cells in the diagnostics.'.format(file))
+            sys.exit(ErrorCode.ASSERTION_FAILED)
+        AssignmentConverter.validateAssignment(file, assignment, num_ranks)
+        with Profiler.stage('convert', file):
+            mappings[interval] = AssignmentConverter.convertAssignment(ranks, indices, assignment, num_ranks, num_indices)
+
+    arrays = {'mappings': mappings}
+    saveCache(cache_dir, 'mappings', key, arrays)
+    return key, arrays
+
+# Main function
+def main():
+    # enable profiling if requested
+    sys.argv = Profiler.parseFlag(sys.argv)
+
+    # check if the user provided a directory
+    if len(sys.argv) < InputArg.LENGTH:
+        print('Usage: {} <directory> [assignment_directory] [-o {}] [-f] [--ranks-per-node=N | --hostfile=file] [--extract=<spec>]'.format(sys.argv[InputArg.PROGRAM_NAME], ','.join(Artifact.ALL)))
+        print('  {} writes the summed load per rank, per node and the imbalance as RankSteps_Ranks.csv, RankSteps_Nodes.csv and RankSteps_Imbalance.csv'.format(Artifact.LOAD_BALANCE))
+        sys.exit(ErrorCode.INVALID_ARGUMENTS)
+
+    # get the directory and the optional assignment directory from the command line
+    directory = sys.argv[InputArg.DIRECTORY]
+    arguments = sys.argv[InputArg.LENGTH:]
+    assignment_dir = None
+    if len(arguments) > 0 and not arguments[0].startswith('-'):
+        assignment_dir = arguments[0]
+        arguments = arguments[1:]
+
+    # optionally check for flags
+    flags = arguments
+    # force flag: '-f' or '--force', recompute all stages
+    force = '-f' in flags or '--force' in flags
+    if force:
+        print('Force: enabled.')
+    # outputs flag: '-o' or '--outputs', comma separated list of artifacts to write
+    outputs = Flags.getFlagValue(flags, '-o', '--outputs')
+    outputs = outputs.split(',') if outputs is not None else list(Artifact.DEFAULT)
+    unknown = [output for output in outputs if output not in Artifact.ALL]
+    if len(unknown) > 0:
+        print('Error: Unknown outputs {}, expected any of {}.'.format(unknown, Artifact.ALL))
+        sys.exit(ErrorCode.INVALID_ARGUMENTS)
+    # extract flag: '--extract=<spec>', extract more variables and reductions in the columns stage
+    # spec is 'variable:reduction,...' or a JSON file, with reductions column, level, max and hist
+    extract = Flags.getFlagValue(flags, None, '--extract')
+    spec = []
+    if extract is not None:
+        try:
+            spec = KppExtract.parseSpec(extract)
+        except (OSError, ValueError) as e:
+            print('Error: Invalid extraction spec \'{}\': {}'.format(extract, e))
+            sys.exit(ErrorCode.INVALID_ARGUMENTS)
+        if Artifact.EXTRACT not in outputs:
+            outputs.append(Artifact.EXTRACT)
+    elif Artifact.EXTRACT in outputs:
+        print('Error: Output {} needs --extract.'.format(Artifact.EXTRACT))
+        sys.exit(ErrorCode.INVALID_ARGUMENTS)
+    # mappings can only be written with an assignment directory
+    if assignment_dir is None:
+        outputs = [output for output in outputs if output not in Artifact.ASSIGNMENTS]
+    needAssignments = any(output in Artifact.ASSIGNMENTS for output in outputs)
+    print('Outputs: {}.'.format(', '.join(outputs)))
+    # topology flags: '--ranks-per-node=N' or '--hostfile=file', needed for the load balance
+    ranks_per_node = Flags.getFlagValue(flags, None, '--ranks-per-node')
+    hostfile = Flags.getFlagValue(flags, None, '--hostfile')
+    if Artifact.LOAD_BALANCE in outputs and ranks_per_node is None and hostfile is None:
+        print('Error: Output {} needs --ranks-per-node or --hostfile.'.format(Artifact.LOAD_BALANCE))
+        sys.exit(ErrorCode.INVALID_ARGUMENTS)
+    if Artifact.LOAD_BALANCE in outputs:
+        Topology.checkNodeFlags(ranks_per_node, hostfile)
+
+    # find all KPP diagnostics files in the directory
+    if not os.path.isdir(directory):
+        print('Error: Invalid directory \'{}\'.'.format(directory))
+        sys.exit(ErrorCode.FILE_NOT_FOUND)
+    with Profiler.stage('find'):
+        files = KppSeries.findKppDiagsFiles(directory)
+    if len(files) == 0:
+        print('Error: No KPP diagnostics files found in \'{}\'.'.format(directory))
+        sys.exit(ErrorCode.FILE_NOT_FOUND)
+
+    # find all assignment files in the assignment directory
+    assignment_files = {}
+    if needAssignments:
+        if not os.path.exists(assignment_dir):
+            print('Error: Assignment file/directory \'{}\' not found.'.format(assignment_dir))
+            sys.exit(ErrorCode.FILE_NOT_FOUND)
+        assignment_files = AssignmentConverter.findAssignmentFiles(assignment_dir)
+        if len(assignment_files) == 0:
+            print('Error: No interval_N.assignment files found in \'{}\'.'.format(assignment_dir))
+            sys.exit(ErrorCode.FILE_NOT_FOUND)
+
+    cache_dir = os.path.join(directory, CACHE_DIR)
+
+    # stage 1: always needed as it feeds every artifact
+    columnsKey, columns = runColumns(files, cache_dir, force, spec)
+    needRanks = Artifact.RANK_INDEX in outputs or Artifact.RANK_STEPS in outputs or Artifact.LOAD_BALANCE in outputs or needAssignments
+    if needRanks and len(columns['ranks']) == 0:
+        print('Error: Missing keys {}'.format('KppRank'))
+        sys.exit(ErrorCode.KEY_NOT_FOUND)
+
+    if Artifact.TOTAL_STEPS in outputs:
+        costDf = pd.DataFrame(columns['costs'], columns=columns['timestamps'])
+        totalFile = os.path.join(directory, 'TotalSteps.csv')
+        with Profiler.stage('write', totalFile):
+            costDf.to_csv(totalFile, index=True)
+
+    if Artifact.EXTRACT in outputs:
+        KppExtract.writeExtract(os.path.join(directory, KppExtract.EXTRACT_FILE),
+                                {name[len(EXTRACT_PREFIX):]: array for name, array in columns.items() if name.startswith(EXTRACT_PREFIX)})
+
+    if Artifact.COST_CUBE in outputs:
+        costs = columns['costs']
+        num_ranks = int(columns['ranks'].max()) + 1 if len(columns['ranks']) > 0 else None
+        try:
+            resolution = CubedSphereCurve.resolutionOf(costs.shape[0])
+        except ValueError as e:
+            print('Error: {}'.format(e))
+            sys.exit(ErrorCode.ASSERTION_FAILED)
+        CostCube.publishCostCube(directory, list(columns['timestamps']), costs, resolution, num_ranks)
+
+    if Artifact.RANK_INDEX in outputs:
+        rankDf = pd.DataFrame({'KppRank': columns['ranks'], 'KppIndexOnRank': columns['indices']})
+        rankFile = os.path.join(directory, 'RankIndex.csv')
+        with Profiler.stage('write', rankFile):
+            rankDf.to_csv(rankFile, index=True)
+
+    # stage 2: only run if its artifact is requested
+    if Artifact.RANK_STEPS in outputs:
+        _, rankSteps = runRankSteps(columns, columnsKey, cache_dir, force)
+        df = KppAggregator.rankStepsToDataFrame(rankSteps['steps'])
+        stepsFile = os.path.join(directory, 'RankSteps.csv')
+        with Profiler.stage('write', stepsFile):
+            df.to_csv(stepsFile, index=False)
+
+    # load per rank, per node and globally, computed directly from the column costs
+    if Artifact.LOAD_BALANCE in outputs:
+        ranks = columns['ranks']
+        num_ranks = int(ranks.max()) + 1
+        node_of_rank, node_names = Topology.nodeMap(num_ranks, ranks_per_node, hostfile)
+        with Profiler.stage('topology'):
+            load = Topology.aggregateLoad(columns['costs'], ranks, node_of_rank, num_ranks)
+        # sums over the cells, unlike RankSteps.csv which keeps the maximum column of each rank
+        for name, df in [('Ranks', Topology.rankLoadToDataFrame(load)),
+                         ('Nodes', Topology.nodeLoadToDataFrame(load, node_names)),
+                         ('Imbalance', Topology.imbalanceToDataFrame(load))]:
+            loadFile = os.path.join(directory, 'RankSteps_{}.csv'.format(name))
+            with Profiler.stage('write', loadFile):
+                df.to_csv(loadFile, index=False)
+
+    # stage 3: only run if its artifact is requested
+    if needAssignments:
+        _, mappings = runMappings(columns, columnsKey, assignment_files, cache_dir, force)
+        mapping_dir = assignment_dir.replace('Assignments', 'Mappings')
+        os.makedirs(mapping_dir, exist_ok=True)
+        if Artifact.MAPPINGS in outputs:
+            AssignmentConverter.writeRankMappings(mapping_dir, mappings['mappings'])
+        if Artifact.DELTA_MAPPINGS in outputs:
+            AssignmentConverter.writeDeltaMappings(os.path.join(mapping_dir, AssignmentConverter.DELTA_MAPPINGS_FILE),
+                                                   mappings['mappings'], list(assignment_files.keys()))
+        if Artifact.MIGRATION_STATS in outputs:
+            stats = AssignmentConverter.migrationStatistics(mappings['mappings'], list(assignment_files.keys()))
+            AssignmentConverter.writeMigrationStatistics(os.path.join(mapping_dir, AssignmentConverter.MIGRATION_STATS_FILE), stats)
+
+    # report the profile if enabled
+    Profiler.report(os.path.join(directory, 'Pipeline.profile.json'))
+
+# Run the main function
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import json
+import time
+import resource
+from contextlib import contextmanager, nullcontext
+
+# Shared per-stage instrumentation for the command line tools.
+# Stages are recorded as wall time, bytes read and peak RSS, optionally per file.
+# When profiling is disabled, stage() returns a shared no-op context so the overhead is a single call.
+
+# Flag used by every command line tool to enable profiling
+PROFILE_FLAG = '--profile'
+
+# Shared no-op context returned when profiling is disabled
+_disabled = nullcontext()
+
+# Recorded stages in order of completion
+_records = []
+# Whether profiling is enabled
+_enabled = False
+# Start time of the profiled run
+_start = 0.0
+# Bytes read from /proc/self/io by the profiler
+_ioBytes = 0
+
+# Enable profiling for the current process
+def enable():
+    global _enabled, _start
+    _enabled = True
+    _start = time.perf_counter()
+
+# Check if profiling is enabled
+def isEnabled() -> bool:
+    return _enabled
+
+# Peak resident set size of the process in bytes
+def peakRss() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024
+
+# Bytes read by the process so far, or None if the platform does not expose it
+# @note: excludes the bytes read from /proc/self/io by the profiler itself
+def bytesRead() -> int | None:
+    global _ioBytes
+    try:
+        fd = os.open('/proc/self/io', os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        content = os.read(fd, 4096)
+    finally:
+        os.close(fd)
+    # rchar does not yet include this read, so subtract only the earlier ones
+    overhead = _ioBytes
+    _ioBytes += len(content)
+    for line in content.decode().splitlines():
+        if line.startswith('rchar:'):
+            return int(line.split()[1]) - overhead
+    return None
+
+@contextmanager
+def _stage(name: str, file: str | None, nbytes: int | None):
+    readBefore = bytesRead() if nbytes is None else None
+    rssBefore = peakRss()
+    begin = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        rssAfter = peakRss()
+        if nbytes is None and readBefore is not None:
+            readAfter = bytesRead()
+            nbytes = readAfter - readBefore if readAfter is not None else None
+        _records.append({
+            'stage': name,
+            'file': file,
+            'start': begin - _start,
+            'seconds': end - begin,
+            'bytes': nbytes,
+            'peak_rss': rssAfter,
+            'rss_growth': rssAfter - rssBefore,
+        })
+
+# Time a stage, optionally attributed to a file
+# @note: bytes read are measured from the process I/O counters unless nbytes is given
+def stage(name: str, file: str | None = None, nbytes: int | None = None):
+    if not _enabled:
+        return _disabled
+    return _stage(name, file, nbytes)
+
+# Aggregate the recorded stages by name, sorted by total wall time
+def hotspots() -> list[dict]:
+    stages = {}
+    for record in _records:
+        entry = stages.setdefault(record['stage'], {
+            'stage': record['stage'],
+            'calls': 0,
+            'seconds': 0.0,
+            'bytes': 0,
+            'peak_rss': 0,
+            'slowest_file': None,
+            'slowest_seconds': 0.0,
+        })
+        entry['calls'] += 1
+        entry['seconds'] += record['seconds']
+        entry['bytes'] += record['bytes'] or 0
+        entry['peak_rss'] = max(entry['peak_rss'], record['peak_rss'])
+        if record['file'] is not None and record['seconds'] > entry['slowest_seconds']:
+            entry['slowest_file'] = record['file']
+            entry['slowest_seconds'] = record['seconds']
+    return sorted(stages.values(), key=lambda entry: entry['seconds'], reverse=True)
+
+# Format a byte count for the summary
+def formatBytes(nbytes: int) -> str:
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if abs(nbytes) < 1024:
+            return '{:.1f} {}'.format(nbytes, unit)
+        nbytes /= 1024
+    return '{:.1f} TiB'.format(nbytes)
+
+# Print a human readable summary of the top hotspots
+def printSummary(top: int = 10):
+    total = time.perf_counter() - _start
+    print('Profile: {:.3f}s total, peak RSS {}'.format(total, formatBytes(peakRss())))
+    print('{:<16} {:>8} {:>10} {:>7} {:>12} {:>12}'.format('Stage', 'Calls', 'Seconds', '%', 'Read', 'Peak RSS'))
+    for entry in hotspots()[:top]:
+        share = 100 * entry['seconds'] / total if total > 0 else 0
+        print('{:<16} {:>8} {:>10.3f} {:>6.1f}% {:>12} {:>12}'.format(
+            entry['stage'], entry['calls'], entry['seconds'], share,
+            formatBytes(entry['bytes']), formatBytes(entry['peak_rss'])))
+        if entry['slowest_file'] is not None:
+            print('  slowest: {} ({:.3f}s)'.format(entry['slowest_file'], entry['slowest_seconds']))
+
+# Write the JSON trace of all recorded stages
+def writeTrace(file: str):
+    trace = {
+        'argv': sys.argv,
+        'seconds': time.perf_counter() - _start,
+        'peak_rss': peakRss(),
+        'hotspots': hotspots(),
+        'stages': _records,
+    }
+    with open(file, 'w') as f:
+        json.dump(trace, f, indent=2)
+    print('Profile trace written to \'{}\'.'.format(file))
+
+# Write the JSON trace and print the summary if profiling is enabled
+def report(file: str, top: int = 10):
+    if not _enabled:
+        return
+    printSummary(top)
+    writeTrace(file)
+
+# Remove the profile flag from the arguments and enable profiling if it was present
+def parseFlag(argv: list[str]) -> list[str]:
+    if PROFILE_FLAG not in argv:
+        return argv
+    enable()
+    return [arg for arg in argv if arg != PROFILE_FLAG]
@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+# Rank to node topology and hierarchical rank -> node -> global load aggregation.
+# Imbalance is split into inter-node imbalance (the most loaded node against the global mean, per rank),
+# which needs MPI migration to fix, and intra-node imbalance (the most loaded rank of a node against
+# the mean of its node), which threads within the node can absorb.
+
+# Error code enumeration
+class ErrorCode:
+    SUCCESS = 0
+    INVALID_ARGUMENTS = 1
+    FILE_NOT_FOUND = 2
+    ASSERTION_FAILED = -1
+
+# Map ranks to nodes by filling each node with a fixed number of consecutive ranks
+def ranksPerNode(num_ranks: int, ranks_per_node: int) -> np.ndarray:
+    return np.arange(num_ranks) // ranks_per_node
+
+# Read a hostfile and map ranks to nodes in order, filling the slots of each host
+# Lines may be 'host slots=N' (Open MPI), 'host:N' (MPICH) or 'host' (one slot, repeated per rank),
+# blank lines and '#' comments are ignored
+# @return: the node of each rank and the names of the nodes
+def readHostfile(file: str) -> tuple[np.ndarray, list[str]]:
+    names = []
+    slots = {}
+    with open(file, 'r') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if len(line) == 0:
+                continue
+            fields = line.split()
+            host, count = fields[0], 1
+            if ':' in host:
+                host, count = host.split(':', 1)
+                count = int(count)
+            for field in fields[1:]:
+                if field.startswith('slots='):
+                    count = int(field[len('slots='):])
+            if host not in slots:
+                names.append(host)
+                slots[host] = 0
+            slots[host] += count
+    node_of_rank = np.repeat(np.arange(len(names)), [slots[host] for host in names])
+    return node_of_rank, names
+
+# Check the '--hostfile=file' and '--ranks-per-node=N' flag values before any data is read
+# @return: the node of each slot and the names of the nodes read from the hostfile, or None and None without one
+# @note: exits with FILE_NOT_FOUND on a missing hostfile and INVALID_ARGUMENTS on a bad slot count or ranks per node
+def checkNodeFlags(ranks_per_node: str | None = None, hostfile: str | None = None) -> tuple[np.ndarray | None, list[str] | None]:
+    if hostfile is not None:
+        if not os.path.exists(hostfile):
+            print('Error: hostfile not found')
+            sys.exit(ErrorCode.FILE_NOT_FOUND)
+        try:
+            return readHostfile(hostfile)
+        except ValueError:
+            print('Error: hostfile \'{}\' has an invalid slot count'.format(hostfile))
+            sys.exit(ErrorCode.INVALID_ARGUMENTS)
+    if ranks_per_node is not None and (not ranks_per_node.isdigit() or int(ranks_per_node) <= 0):
+        print('Error: ranks per node must be a positive integer, got \'{}\''.format(ranks_per_node))
+        sys.exit(ErrorCode.INVALID_ARGUMENTS)
+    return None, None
+
+# Map the ranks to nodes from the '--hostfile=file' or '--ranks-per-node=N' flag values, checking them first
+# @return: the node of each of the num_ranks ranks and the names of the nodes, or None and None if no topology was given
+# @note: spare hostfile slots and the nodes left without ranks are dropped, too few slots exit with INVALID_ARGUMENTS
+def nodeMap(num_ranks: int, ranks_per_node: str | None = None, hostfile: str | None = None) -> tuple[np.ndarray | None, list[str] | None]:
+    node_of_slot, names = checkNodeFlags(ranks_per_node, hostfile)
+    if hostfile is not None:
+        if len(node_of_slot) < num_ranks:
+            print('Error: hostfile has {} slots for {} ranks'.format(len(node_of_slot), num_ranks))
+            sys.exit(ErrorCode.INVALID_ARGUMENTS)
+        # renumber the nodes that have ranks consecutively
+        used, node_of_rank = np.unique(node_of_slot[:num_ranks], return_inverse=True)
+        return node_of_rank, [names[node] for node in used]
+    if ranks_per_node is not None:
+        return ranksPerNode(num_ranks, int(ranks_per_node)), None
+    return None, None
+
+# Aggregate the (cells, intervals) costs per rank, per node and globally in one vectorized pass
+# @return: a dictionary of the (ranks, intervals) rank load, (nodes, intervals) node load, (intervals,) global load,
+#          and per interval rank imbalance, inter-node imbalance, intra-node imbalance and most imbalanced node
+# @note: only the first num_ranks entries of node_of_rank are used, so the means are over the ranks that exist
+def aggregateLoad(costs: np.ndarray, ranks: np.ndarray, node_of_rank: np.ndarray, num_ranks: int) -> dict[str, np.ndarray]:
+    if ranks.max() >= num_ranks:
+        raise ValueError('Rank {} is outside of the {} ranks.'.format(ranks.max(), num_ranks))
+    if len(node_of_rank) < num_ranks:
+        raise ValueError('Rank {} is not mapped to a node.'.format(len(node_of_rank)))
+    node_of_rank = node_of_rank[:num_ranks]
+    num_nodes = int(node_of_rank.max()) + 1
+
+    rank_load = np.zeros((num_ranks, costs.shape[1]))
+    np.add.at(rank_load, ranks, costs)
+    node_load = np.zeros((num_nodes, costs.shape[1]))
+    np.add.at(node_load, node_of_rank, rank_load)
+    node_max = np.zeros((num_nodes, costs.shape[1]))
+    np.maximum.at(node_max, node_of_rank, rank_load)
+    global_load = rank_load.sum(axis=0)
+
+    # mean load per rank, globally and within each node
+    node_ranks = np.bincount(node_of_rank, minlength=num_nodes).reshape(-1, 1)
+    global_mean = global_load / num_ranks
+    node_mean = node_load / np.maximum(node_ranks, 1)
+
+    # imbalance of 1 is perfect balance, intervals without load are reported as balanced
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rank_imbalance = np.where(global_mean > 0, rank_load.max(axis=0) / global_mean, 1.0)
+        inter_node_imbalance = np.where(global_mean > 0, node_mean.max(axis=0) / global_mean, 1.0)
+        intra_node = np.where(node_mean > 0, node_max / node_mean, 1.0)
+
+    return {
+        'rank_load': rank_load,
+        'node_load': node_load,
+        'global_load': global_load,
+        'rank_imbalance': rank_imbalance,
+        'inter_node_imbalance': inter_node_imbalance,
+        'intra_node_imbalance': intra_node.max(axis=0),
+        'worst_node': intra_node.argmax(axis=0),
+    }
+
+# Create a DataFrame of the summed load per rank per interval
+def rankLoadToDataFrame(load: dict[str, np.ndarray]) -> pd.DataFrame:
+    num_ranks, num_intervals = load['rank_load'].shape
+    df = pd.DataFrame(load['rank_load'], columns=[f'Interval_{j}' for j in range(num_intervals)])
+    df.insert(0, 'Rank', np.arange(num_ranks))
+    return df
+
+# Create a DataFrame of the load per node per interval
+def nodeLoadToDataFrame(load: dict[str, np.ndarray], names: list[str] | None = None) -> pd.DataFrame:
+    num_nodes, num_intervals = load['node_load'].shape
+    df = pd.DataFrame(load['node_load'], columns=[f'Interval_{j}' for j in range(num_intervals)])
+    df.insert(0, 'Node', names if names is not None else np.arange(num_nodes))
+    return df
+
+# Create a DataFrame of the global load and imbalance per interval
+def imbalanceToDataFrame(load: dict[str, np.ndarray]) -> pd.DataFrame:
+    return pd.DataFrame({
+        'Interval': np.arange(len(load['global_load'])),
+        'GlobalLoad': load['global_load'],
+        'RankImbalance': load['rank_imbalance'],
+        'InterNodeImbalance': load['inter_node_imbalance'],
+        'IntraNodeImbalance': load['intra_node_imbalance'],
+        'WorstNode': load['worst_node'],
+    })
@@ -7,10 +7,12 @@ import cartopy
 import gcpy
 import numpy as np
 from scipy.spatial import ConvexHull
+import Topology
 
 # Configuration
 resolution = 180
 processors = 576
+ranks_per_node = 36
 faces = 6
 cells_per_face = resolution * resolution
 corners_per_face = resolution + 1
@@ -30,7 +32,8 @@ assignment_df = pd.read_csv(f"gchp/{plot_type}/{assign_file}", index_col=0)
 processor_map = assignment_df["KppRank"].to_numpy()
 
 # Compute node assignments
-node_map = processor_map // 36
+node_of_rank = Topology.ranksPerNode(processors, ranks_per_node)
+node_map = node_of_rank[processor_map]
 
 # Sum over all levels
 kpp_sum = ds["KppTotSteps"].sum(dim="lev")
@@ -92,7 +95,7 @@ distinct_colors = [
     "black", "magenta", "cyan", "purple", "brown", "gray", "white",
     "orange", "lime", "deepskyblue", "orchid", "gold", "navy", "darkorange",
 ]
-n_hosts = processors // 36
+n_hosts = node_of_rank.max() + 1
 # Repeat colors if not enough for all hosts
 host_colors = [distinct_colors[i % len(distinct_colors)] for i in range(n_hosts)]
 
@@ -159,7 +162,7 @@ for face in range(faces):
                 )
 
             # Assign color by host
-            host_id = proc_id // 36
+            host_id = node_of_rank[proc_id]
             color = host_colors[host_id]
 
             # polygon = patches.Polygon(
@@ -197,7 +200,7 @@ for face in range(faces):
                         plot_edge = True  # At face boundary
                     elif not proc_mask[ni, nj]:
                         neighbor_proc = face_assignments[ni, nj]
-                        neighbor_host = neighbor_proc // 36
+                        neighbor_host = node_of_rank[neighbor_proc]
                         if neighbor_host != host_id:
                             plot_edge = True
                     if plot_edge: